@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+""" Check of the time it takes to import the extension, without a database.
+
+    Usage:
+        python benchmarks/imports.py [--repeat R] [--budget MS]
+
+    Imports the extension '--repeat' times, each in a fresh interpreter
+    (IPython and psycopg2 are imported before the clock starts), and lists
+    which of 'HEAVY_MODULES' got imported along; none of them should be
+    before the first query. The exit status is 1 if the best import time
+    exceeds '--budget' (default: 150 ms), or if any of 'HEAVY_MODULES' is
+    imported. The 'startup' case of 'run.py' additionally times
+    '%pg_connect'.
+    """
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that are only to be imported once results need them
+HEAVY_MODULES = ("numpy", "pandas", "shapely", "geopandas", "pyarrow")
+
+# default maximum time to import the extension, in ms
+BUDGET_MS = 150.
+
+# run by 'time_import' in a fresh interpreter
+IMPORT_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+import IPython.core.interactiveshell, psycopg2.extras
+start = time.perf_counter()
+import ipython_pg.ipython_extension
+import_s = time.perf_counter() - start
+json.dump(dict(import_s=import_s,
+               imported=[m for m in {heavy!r} if m in sys.modules]),
+          sys.stdout)
+"""
+
+
+def time_import(repeat):
+    """Import the extension in 'repeat' fresh interpreters.
+
+    Returns:
+        dict -- best and median time, and the heavy modules imported.
+    """
+    script = IMPORT_SCRIPT.format(root=ROOT, heavy=HEAVY_MODULES)
+    runs = [json.loads(subprocess.check_output([sys.executable, "-c",
+                                                script]).decode())
+            for _ in range(repeat)]
+    times = [run["import_s"] for run in runs]
+    return dict(best_s=min(times), median_s=statistics.median(times),
+                heavy_modules=sorted({m for run in runs
+                                      for m in run["imported"]}))
+
+
+def over_budget(result, budget_ms=BUDGET_MS):
+    """Return the reasons why 'result' of 'time_import' misses the budget."""
+    reasons = []
+    if result["heavy_modules"]:
+        reasons.append("import imports {}".format(
+            ", ".join(result["heavy_modules"])))
+    if result["best_s"] * 1000 > budget_ms:
+        reasons.append("import takes {:.0f} ms (budget: {:.0f} ms)"
+                       .format(result["best_s"] * 1000, budget_ms))
+    return reasons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=BUDGET_MS,
+                        help="maximum time in ms to import the extension")
+    ns = parser.parse_args(argv)
+
+    result = time_import(ns.repeat)
+    sys.stdout.write(json.dumps(result, indent=2) + "\n")
+    reasons = over_budget(result, ns.budget)
+    for reason in reasons:
+        sys.stderr.write("OVER BUDGET: " + reason + "\n")
+    if reasons:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+""" Benchmarks of the hot paths of the magics, against a local PostgreSQL.
+
+    Usage:
+        python benchmarks/run.py [--dsn DSN] [--pg-bin DIR] [--sizes N,...]
+                                 [--repeat R] [--only NAME,...]
+                                 [--import-budget MS] [--output FILE]
+
+    Unless '--dsn' is given, a throwaway server is created with 'initdb' in a
+    temporary directory (listening on a Unix socket only, without fsync)
+    and removed afterwards. Its binaries are looked up in '--pg-bin', in the
+    directory reported by 'pg_config --bindir', and on the PATH. Note that
+    PostgreSQL refuses to run as root. With '--dsn', the benchmark tables
+    are created in the schema 'ipython_pg_bench', which is dropped at the
+    end. Cases with geometries run if PostGIS can be installed in the
+    database (and, for uploads, geopandas is installed).
+
+    The magics are driven through a headless IPython shell. Benchmarks:
+        fetch -- '%pg_pd' (plain, '--copy' and '--stream') of narrow (2
+                 columns), wide (20 columns) and geometry tables.
+        copy -- '%pg_copy' of DataFrames in 'csv' and 'binary' format.
+        template -- substitution of 1 to 1000 '${...}' expressions.
+        render -- 'display_cur_as_table' (fetching and rendering the first
+                  page of results, as '%%pg_sql' does).
+        latency -- 'pgMagics.query' of 'select 1' (small) and of the largest
+                   narrow table (large), blocking (green-mode off), with
+                   green-mode on, and with 'green_mode.wait_select' and
+                   psycopg2's 'wait_select' as wait callbacks.
+        startup -- importing the extension and '%pg_connect', each in a fresh
+                   interpreter (IPython and psycopg2 are imported before the
+                   clock starts). Also lists which of 'HEAVY_MODULES' got
+                   imported; none of them should be before the first query.
+                   'imports.py' checks the import alone, without a server.
+
+    Each case runs '--repeat' times; the best and median times are reported,
+    along with the throughput of the best run. Peak memory is measured in an
+    additional run with tracemalloc, which covers Python, NumPy and pandas
+    allocations but not those of libpq.
+
+    Results are written as JSON (to stdout, or '--output'): the environment
+    (versions, git revision) and one entry per case. Progress goes to
+    stderr. The exit status is 1 if the best import time exceeds
+    '--import-budget' (default: 150 ms), or if the import or '%pg_connect'
+    pulls in any of 'HEAVY_MODULES'.
+    """
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from imports import BUDGET_MS, HEAVY_MODULES, ROOT
+
+sys.path.insert(0, ROOT)
+
+SCHEMA = "ipython_pg_bench"
+
+# run by 'bench_startup' in a fresh interpreter, with the DSN as argument
+STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+import IPython.core.interactiveshell, psycopg2.extras
+start = time.perf_counter()
+import ipython_pg.ipython_extension
+import_s = time.perf_counter() - start
+imported = [m for m in {heavy!r} if m in sys.modules]
+shell = IPython.core.interactiveshell.InteractiveShell.instance()
+shell.write = shell.write_err = lambda text: None
+magics = ipython_pg.ipython_extension.pgMagics(shell)
+start = time.perf_counter()
+magics.pg_connect(sys.argv[1])
+connect_s = time.perf_counter() - start
+json.dump(dict(import_s=import_s, connect_s=connect_s, imported=imported,
+               connected=[m for m in {heavy!r} if m in sys.modules],
+               ok=magics.dbconn is not None), sys.stdout)
+"""
+
+# columns of the wide table: name and SQL expression over 'g'
+WIDE_COLUMNS = ([("i{}".format(i), "g + {}".format(i)) for i in range(5)]
+                + [("f{}".format(i), "g / {}.0::float8".format(i + 1))
+                   for i in range(5)]
+                + [("t{}".format(i), "md5((g + {})::text)".format(i))
+                   for i in range(4)]
+                + [("ts{}".format(i), "now() + g * interval '{} s'"
+                    .format(i + 1)) for i in range(3)]
+                + [("b0", "mod(g, 2) = 0"), ("n0", "(g / 7.0)::numeric"),
+                   ("z0", "case when mod(g, 3) = 0 then null else g end")])
+
+
+class Server(object):
+    """Throwaway PostgreSQL server in a temporary directory."""
+
+    def __init__(self, pg_bin=None):
+        self.pg_bin = pg_bin
+        self.directory = None
+
+    def _bin(self, name):
+        candidates = []
+        if self.pg_bin:
+            candidates.append(os.path.join(self.pg_bin, name))
+        try:
+            bindir = subprocess.check_output(["pg_config", "--bindir"],
+                                             stderr=subprocess.DEVNULL)
+            candidates.append(os.path.join(bindir.decode().strip(), name))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        candidates.append(shutil.which(name))
+        for path in candidates:
+            if path and os.access(path, os.X_OK):
+                return path
+        raise SystemExit("ERROR: '{}' not found; pass --pg-bin or --dsn"
+                         .format(name))
+
+    def __enter__(self):
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            raise SystemExit("ERROR: PostgreSQL refuses to run as root; "
+                             "pass --dsn of a running server")
+        self.directory = tempfile.mkdtemp(prefix="ipython_pg_bench_")
+        data = os.path.join(self.directory, "data")
+        subprocess.check_call([self._bin("initdb"), "-D", data, "-U",
+                               "postgres", "--auth=trust", "-E", "UTF8",
+                               "--no-sync"], stdout=subprocess.DEVNULL)
+        options = ("-k {} -h '' -c fsync=off -c synchronous_commit=off "
+                   "-c full_page_writes=off".format(self.directory))
+        subprocess.check_call([self._bin("pg_ctl"), "-D", data, "-o",
+                               options, "-l",
+                               os.path.join(self.directory, "log"), "-w",
+                               "start"], stdout=subprocess.DEVNULL)
+        return "host={} user=postgres dbname=postgres".format(self.directory)
+
+    def __exit__(self, *exc):
+        subprocess.call([self._bin("pg_ctl"), "-D",
+                         os.path.join(self.directory, "data"), "-m",
+                         "immediate", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def headless_shell(dsn):
+    """Return an IPython shell with the magics connected to 'dsn'."""
+    from IPython.core.interactiveshell import InteractiveShell
+    from ipython_pg.ipython_extension import pgMagics
+
+    shell = InteractiveShell.instance()
+    output = io.StringIO()
+    shell.write = output.write
+    shell.write_err = sys.stderr.write
+    magics = pgMagics(shell)
+    shell.register_magics(magics)
+    shell.run_line_magic("pg_connect", dsn)
+    if magics.dbconn is None:
+        raise SystemExit("ERROR: unable to connect to '{}'".format(dsn))
+    return shell, magics
+
+
+def measure(func, repeat, setup=None):
+    """Time 'repeat' runs of 'func', then one more for peak memory."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(best_s=min(times), median_s=statistics.median(times),
+                peak_mb=peak / float(1 << 20))
+
+
+def execute(magics, sql):
+    with magics.dbconn.cursor() as cur:
+        cur.execute(sql)
+    magics.dbconn.commit()
+
+
+def has_postgis(magics):
+    try:
+        execute(magics, "CREATE EXTENSION IF NOT EXISTS postgis")
+        return True
+    except Exception:
+        magics.dbconn.rollback()
+        return False
+
+
+def create_tables(magics, sizes, postgis):
+    """Create the tables read by 'fetch', one per shape and size."""
+    execute(magics, "DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}"
+            .format(SCHEMA))
+    shapes = {"narrow": "g::int8 AS id, g / 3.0::float8 AS v",
+              "wide": ", ".join("{} AS {}".format(e, n)
+                                for n, e in WIDE_COLUMNS)}
+    if postgis:
+        shapes["geometry"] = ("g AS id, ST_SetSRID(ST_MakePoint(g / 1000.0, "
+                              "mod(g, 1000) / 10.0), 4326) AS geom")
+    tables = {}
+    for shape, columns in shapes.items():
+        for n in sizes:
+            name = "{}.{}_{}".format(SCHEMA, shape, n)
+            progress("creating {}".format(name))
+            execute(magics, "CREATE TABLE {} AS SELECT {} FROM "
+                    "generate_series(1, {}) g".format(name, columns, n))
+            tables[shape, n] = name
+    return tables
+
+
+def bench_fetch(shell, magics, tables, repeat):
+    for (shape, n), table in sorted(tables.items()):
+        for options in ("", "--copy", "--stream"):
+            progress("fetch {} {} {}".format(shape, n, options))
+
+            def run():
+                shell.run_cell_magic("pg_pd", options,
+                                     "select * from {}".format(table))
+            yield dict(case="{} {}".format(shape, options).strip(), rows=n,
+                       **measure(run, repeat))
+
+
+def bench_copy(shell, magics, tables, repeat):
+    import pandas as pd
+
+    frames = {}
+    for (shape, n), table in sorted(tables.items()):
+        if shape == "geometry":
+            try:
+                import geopandas  # noqa: F401 (required to upload shapely)
+            except ImportError:
+                continue
+        magics._dbconn().rollback()
+        frames[shape, n] = shell.run_cell_magic(
+            "pg_pd", "", "select * from {}".format(table))
+        if shape == "geometry" and hasattr(frames[shape, n], "crs"):
+            frames[shape, n] = frames[shape, n].set_crs(4326,
+                                                        allow_override=True)
+        execute(magics, "CREATE TABLE {0}_target AS SELECT * FROM {0} "
+                "WITH NO DATA".format(table))
+
+    for (shape, n), dta in sorted(frames.items()):
+        table = tables[shape, n]
+        shell.user_ns["_bench_frame"] = pd.DataFrame(dta) \
+            if shape != "geometry" else dta
+        for fmt in ("csv", "binary"):
+            progress("copy {} {} {}".format(shape, n, fmt))
+
+            def setup():
+                execute(magics, "TRUNCATE {}_target".format(table))
+
+            def run():
+                shell.run_line_magic("pg_copy", "_bench_frame {}_target "
+                                     "--format {}".format(table, fmt))
+            yield dict(case="{} {}".format(shape, fmt), rows=n,
+                       **measure(run, repeat, setup))
+    shell.user_ns.pop("_bench_frame", None)
+
+
+def bench_template(shell, magics, tables, repeat):
+    shell.user_ns["_bench_value"] = 42
+    for k in (1, 10, 100, 1000):
+        sql = "select " + ", ".join("${_bench_value}" for _ in range(k))
+        calls = max(10000 // k, 10)
+        progress("template {} expressions".format(k))
+
+        def run():
+            for _ in range(calls):
+                magics._python_tpl(sql)
+        result = measure(run, repeat)
+        result["calls_per_s"] = calls / result["best_s"]
+        yield dict(case="{} expressions".format(k), rows=None, **result)
+
+
+def bench_render(shell, magics, tables, repeat):
+    cursors = []
+    for (shape, n), table in sorted(tables.items()):
+        if shape == "geometry":
+            continue
+        progress("render {} {}".format(shape, n))
+
+        def setup():
+            cursors[:] = [magics.query("select * from {}".format(table),
+                                       silent=True)]
+
+        def run():
+            magics.display_cur_as_table(cursors[0])
+        yield dict(case=shape, rows=min(n, 500), table_rows=n,
+                   **measure(run, repeat, setup))
+
+
+def bench_latency(shell, magics, tables, repeat):
+    import psycopg2.extensions
+    import psycopg2.extras
+    from ipython_pg import green_mode
+
+    modes = [("blocking", False, None), ("green-mode", True, None),
+             ("wait_select", False, green_mode.wait_select),
+             ("psycopg2 wait_select", False, psycopg2.extras.wait_select)]
+    sizes = [n for shape, n in tables if shape == "narrow"]
+    queries = [("small", "select 1", 2000, None)]
+    if sizes:
+        queries.append(("large", "select * from {}".format(
+            tables["narrow", max(sizes)]), 1, max(sizes)))
+    for _, sql, calls, _ in queries:  # warm up (caches, CPU clock)
+        for _ in range(calls):
+            magics.query(sql, silent=True)
+    try:
+        for mode, green, callback in modes:
+            if green:
+                green_mode.activate()
+            else:
+                green_mode.deactivate()
+            psycopg2.extensions.set_wait_callback(callback)
+            for size, sql, calls, rows in queries:
+                progress("latency {} {}".format(mode, size))
+
+                def run():
+                    for _ in range(calls):
+                        magics.query(sql, silent=True)
+                result = measure(run, repeat)
+                result["latency_us"] = result["best_s"] / calls * 1e6
+                yield dict(case="{} {}".format(mode, size), rows=rows,
+                           **result)
+    finally:
+        psycopg2.extensions.set_wait_callback(None)
+        if magics.green_mode:
+            green_mode.activate()
+        else:
+            green_mode.deactivate()
+
+
+def bench_startup(shell, magics, tables, repeat):
+    progress("startup")
+    script = STARTUP_SCRIPT.format(root=ROOT, heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", script,
+                                          magics.bench_dsn])
+        runs.append(json.loads(output.decode()))
+    if not all(run["ok"] for run in runs):
+        raise SystemExit("ERROR: '%pg_connect' failed in a fresh interpreter")
+    for case, key, modules in (("import", "import_s", "imported"),
+                               ("pg_connect", "connect_s", "connected")):
+        times = [run[key] for run in runs]
+        yield dict(case=case, rows=None, best_s=min(times),
+                   median_s=statistics.median(times),
+                   heavy_modules=runs[0][modules])
+
+
+BENCHMARKS = dict(fetch=bench_fetch, copy=bench_copy,
+                  template=bench_template, render=bench_render,
+                  latency=bench_latency, startup=bench_startup)
+
+
+def over_budget(results, budget_ms):
+    """Return the reasons why the startup results miss their budget."""
+    reasons = []
+    for entry in results:
+        if entry["benchmark"] != "startup":
+            continue
+        if entry["heavy_modules"]:
+            reasons.append("{} imports {}".format(
+                entry["case"], ", ".join(entry["heavy_modules"])))
+        if entry["case"] == "import" and entry["best_s"] * 1000 > budget_ms:
+            reasons.append("import takes {:.0f} ms (budget: {:.0f} ms)"
+                           .format(entry["best_s"] * 1000, budget_ms))
+    return reasons
+
+
+def environment(magics):
+    import numpy as np
+    import pandas as pd
+    import psycopg2
+
+    env = dict(started=datetime.datetime.now().isoformat(),
+               python=platform.python_version(), platform=platform.platform(),
+               psycopg2=psycopg2.__version__, pandas=pd.__version__,
+               numpy=np.__version__,
+               server=magics.dbconn.server_version)
+    try:
+        env["revision"] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env["revision"] = None
+    return env
+
+
+def progress(message):
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dsn", help="connect to this server instead of "
+                        "starting one")
+    parser.add_argument("--pg-bin", dest="pg_bin",
+                        help="directory of initdb and pg_ctl")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="comma-separated numbers of rows")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="comma-separated benchmarks to run "
+                        "(default: all of {})".format(",".join(BENCHMARKS)))
+    parser.add_argument("--import-budget", dest="import_budget", type=float,
+                        default=BUDGET_MS, help="maximum time in ms to import "
+                        "the extension (see the 'startup' benchmark)")
+    parser.add_argument("--output", help="file to write the results to")
+    ns = parser.parse_args(argv)
+
+    sizes = [int(n) for n in ns.sizes.split(",")]
+    names = ns.only.split(",") if ns.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(unknown)))
+
+    server = (contextlib.nullcontext(ns.dsn) if ns.dsn
+              else Server(ns.pg_bin))
+    with server as dsn:
+        shell, magics = headless_shell(dsn)
+        magics.bench_dsn = dsn
+        postgis = has_postgis(magics)
+        results = dict(environment=environment(magics), results=[])
+        results["environment"]["postgis"] = postgis
+        try:
+            tables = create_tables(magics, sizes, postgis)
+            for name in names:
+                for entry in BENCHMARKS[name](shell, magics, tables,
+                                              ns.repeat):
+                    if entry["rows"]:
+                        entry["rows_per_s"] = entry["rows"] / entry["best_s"]
+                    results["results"].append(dict(benchmark=name, **entry))
+        finally:
+            magics._dbconn().rollback()
+            execute(magics, "DROP SCHEMA IF EXISTS {} CASCADE"
+                    .format(SCHEMA))
+            shell.run_line_magic("pg_disconnect", "")
+
+    text = json.dumps(results, indent=2)
+    if ns.output:
+        with open(ns.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+    reasons = over_budget(results["results"], ns.import_budget)
+    for reason in reasons:
+        progress("OVER BUDGET: " + reason)
+    if reasons:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+""" Encode pandas DataFrames in PostgreSQL's binary COPY format.
+
+    Each row of a binary COPY stream is a 16-bit field count followed by one
+    32-bit length (-1 for NULL) and the raw value per field. The functions in
+    this module build these rows column by column from the NumPy arrays of a
+    DataFrame: every column is converted to the network byte order
+    representation of its target type in one go, and the fields are then
+    scattered into a single output buffer using index arithmetic. Only
+    'numeric', 'bytea' and text-like columns need a Python-level step per
+    value. Geometries are sent as EWKB, like 'bytea' values (see
+    'postgis_integration.adapt_shapely_array').
+
+    The binary format is strict: every value must be sent in the exact
+    representation of its target column, so the column types need to be
+    known in advance (see 'encode_rows').
+    """
+
+from decimal import Decimal
+import struct
+import numpy as np
+import pandas as pd
+
+from .dataframes import (BOOL, BYTEA, INT2, INT4, INT8, FLOAT4, FLOAT8,
+                         NUMERIC, DATE, TIMESTAMP, TIMESTAMPTZ, JSON, JSONB,
+                         TEXT_TYPES)
+
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+TRAILER = struct.pack(">h", -1)
+
+# dates and timestamps count from 2000-01-01
+_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+
+_INTEGER_TYPES = {INT2: ">i2", INT4: ">i4", INT8: ">i8"}
+_FLOAT_TYPES = {FLOAT4: ">f4", FLOAT8: ">f8"}
+
+# sign words of the binary numeric representation
+_NUMERIC_POS = 0x0000
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+
+
+def encode_rows(columns, type_codes, encoding="utf-8", timezone="UTC"):
+    """Encode the rows of a DataFrame (without header and trailer).
+
+    Arguments:
+        columns {list} -- one pandas Series per field, all of equal length.
+        type_codes {list} -- type OID of the target column of each field.
+        encoding {str} -- Python codec to encode text with (default: utf-8).
+        timezone {str} -- time zone of naive datetimes that go into
+                          'timestamp with time zone' columns (default: UTC).
+
+    Returns:
+        bytes
+    """
+    n = len(columns[0]) if columns else 0
+    if n == 0:
+        return b""
+
+    lengths, payloads = [], []
+    for values, type_code in zip(columns, type_codes):
+        length, data = encode_column(values, type_code, encoding, timezone)
+        lengths.append(length)
+        payloads.append(data)
+
+    # each field takes a 4 byte length plus its data; each row a 2 byte count
+    fields = [4 + np.maximum(length, 0) for length in lengths]
+    sizes = 2 + np.sum(fields, axis=0)
+    starts = np.cumsum(sizes) - sizes
+    buff = np.empty(int(sizes.sum()), dtype=np.uint8)
+
+    count = np.full(n, len(columns), dtype=">i2").view(np.uint8)
+    _scatter(buff, starts, np.full(n, 2), count)
+    pos = starts + 2
+    for length, data, field in zip(lengths, payloads, fields):
+        _scatter(buff, pos, np.full(n, 4),
+                 length.astype(">i4").view(np.uint8))
+        _scatter(buff, pos + 4, np.maximum(length, 0), data)
+        pos = pos + field
+    return buff.tobytes()
+
+
+def encode_column(values, type_code, encoding="utf-8", timezone="UTC"):
+    """Encode a Series as values of the postgres type 'type_code'.
+
+    Missing values (None, NaN, NaT, pd.NA) are encoded as NULL.
+
+    Returns:
+        tuple -- the length of each field (-1 for NULL) as int64 array, and
+                 the concatenated data of all non-NULL fields as uint8 array.
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    null = values.isna().to_numpy()
+    present = values[~null]
+
+    if type_code in _INTEGER_TYPES:
+        data = _integers(present, np.dtype(_INTEGER_TYPES[type_code]))
+    elif type_code in _FLOAT_TYPES:
+        data = present.to_numpy(dtype=_FLOAT_TYPES[type_code])
+    elif type_code == BOOL:
+        data = present.to_numpy(dtype=np.bool_)
+    elif type_code in (TIMESTAMP, TIMESTAMPTZ):
+        data = _timestamps(present, type_code == TIMESTAMPTZ, timezone)
+    elif type_code == DATE:
+        data = _dates(present)
+    elif type_code == NUMERIC:
+        return _variable(null, [_numeric(v) for v in present])
+    elif type_code in TEXT_TYPES or type_code == JSON:
+        return _variable(null, [str(v).encode(encoding) for v in present])
+    elif type_code == BYTEA:
+        return _variable(null, [bytes(v) for v in present])
+    elif type_code == JSONB:  # version byte, followed by the text
+        return _variable(null, [b"\x01" + str(v).encode(encoding)
+                                for v in present])
+    else:
+        raise ValueError("binary COPY does not support columns of type {}; "
+                         "use the csv format instead".format(type_code))
+
+    length = np.where(null, -1, data.dtype.itemsize).astype(np.int64)
+    return length, np.ascontiguousarray(data).view(np.uint8).ravel()
+
+
+def _scatter(buff, starts, sizes, data):
+    """Copy consecutive chunks of 'sizes' bytes of 'data' to 'starts'."""
+    keep = sizes > 0
+    starts, sizes = starts[keep], sizes[keep]
+    if not len(sizes):
+        return
+    offsets = np.cumsum(sizes) - sizes
+    buff[np.repeat(starts - offsets, sizes) + np.arange(sizes.sum())] = data
+
+
+def _variable(null, encoded):
+    """Lengths and data of variable length fields."""
+    length = np.full(len(null), -1, dtype=np.int64)
+    length[~null] = [len(e) for e in encoded]
+    return length, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def _integers(values, dtype):
+    """Convert to big-endian integers, refusing to truncate or overflow."""
+    values = values.to_numpy()
+    if values.dtype.kind == "f" and not np.all(np.trunc(values) == values):
+        raise ValueError("cannot COPY fractional values into an integer "
+                         "column")
+    if values.dtype.kind not in "iub":
+        values = values.astype(np.float64 if values.dtype.kind == "f"
+                               else np.int64)
+    info = np.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        raise ValueError("value out of range for {}-bit integer column"
+                         .format(8 * dtype.itemsize))
+    return values.astype(dtype)
+
+
+def _timestamps(values, with_tz, timezone):
+    """Microseconds since 2000-01-01 (in UTC if 'with_tz')."""
+    values = pd.to_datetime(values)
+    if values.dt.tz is None and with_tz:
+        values = values.dt.tz_localize(timezone)
+    if values.dt.tz is not None:
+        if with_tz:
+            values = values.dt.tz_convert("UTC")
+        values = values.dt.tz_localize(None)
+    values = values.to_numpy(dtype="datetime64[us]")
+    return (values - _EPOCH).astype(">i8")
+
+
+def _dates(values):
+    """Days since 2000-01-01."""
+    values = pd.to_datetime(values)
+    if values.dt.tz is not None:
+        values = values.dt.tz_localize(None)
+    values = values.to_numpy(dtype="datetime64[D]")
+    return (values - _EPOCH.astype("datetime64[D]")).astype(">i4")
+
+
+def _numeric(value):
+    """Binary representation of a numeric value (base 10000 digits)."""
+    if isinstance(value, (float, np.floating)):
+        value = Decimal(repr(float(value)))
+    elif not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if value.is_nan():
+        return struct.pack(">hhHH", 0, 0, _NUMERIC_NAN, 0)
+    if value.is_infinite():
+        raise ValueError("cannot COPY infinite values into a numeric column")
+
+    sign, digits, exponent = value.as_tuple()
+    digits = "".join(str(d) for d in digits)
+    scale = max(0, -exponent)
+    if exponent >= 0:
+        digits += "0" * exponent
+        scale = 0
+    # align the decimal point with a group of four digits on both sides
+    digits += "0" * (-scale % 4)
+    digits = "0" * (-len(digits) % 4) + digits
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = len(groups) - (scale + 3) // 4 - 1
+
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+
+    return struct.pack(">hhHH{}H".format(len(groups)), len(groups), weight,
+                       _NUMERIC_NEG if sign else _NUMERIC_POS, scale,
+                       *groups)
@@ -0,0 +1,257 @@
+""" Client-side cache of query results.
+
+    Results are kept in memory, least recently used first out once the
+    memory budget is exceeded. Optionally, DataFrames are also written to a
+    directory as Parquet files (requires 'pyarrow'), from where they are
+    loaded again when they are no longer (or not yet) held in memory, e.g.
+    after a kernel restart. Entries expire after a time-to-live, if set.
+
+    Results are stored under a key derived from the fully rendered query and
+    the connection it ran on (see 'ResultCache.key'). The cache knows nothing
+    about the database, so it is up to its user to clear it when data may
+    have changed.
+    """
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# stand-in for the columns of 'cursor.description' of results read from disk
+Column = namedtuple("Column", ["name", "type_code"])
+
+# name of the Parquet metadata entry holding the description
+_METADATA = b"ipython_pg.description"
+
+_RXP_FILE = re.compile(r"^[0-9a-f]{64}\.parquet$")
+
+
+class ResultCache(object):
+    """LRU cache of query results with a memory budget and optional TTL."""
+
+    def __init__(self, maxbytes=256 << 20, ttl=None, directory=None):
+        """Create a new (empty) cache.
+
+        Arguments:
+            maxbytes {int} -- memory budget in bytes (default: 256 MiB).
+            ttl {float} -- seconds after which entries expire; if None,
+                           they never do (default: None).
+            directory {str} -- if given, also store DataFrames as Parquet
+                               files in this directory (default: None).
+        """
+        self.maxbytes = int(maxbytes)
+        self.ttl = None if ttl is None else float(ttl)
+        self.directory = directory
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: (value, description, size, time)
+        self._lock = threading.RLock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Return the key of a result identified by 'parts'.
+
+        Arguments:
+            parts -- anything that identifies the result, e.g. the kind of
+                     result, the rendered query (as returned by
+                     'cursor.mogrify') and the DSN of the connection.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            elif not isinstance(part, bytes):
+                part = repr(part).encode("utf-8")
+            digest.update(len(part).to_bytes(8, "big") + part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached (result, description), or None if missing.
+
+        DataFrames are returned as a copy, so they can be modified freely.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[3]):
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            else:
+                entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        value, description = entry[:2]
+        if hasattr(value, "copy"):
+            value = value.copy()
+        return value, description
+
+    def put(self, key, value, description):
+        """Store a DataFrame or a list of rows with its description.
+
+        Results larger than the memory budget are only written to disk.
+        DataFrames are stored as a copy, so the caller may go on modifying
+        'value'.
+        """
+        now = time.time()
+        size = _sizeof(value)
+        if self.directory is not None and hasattr(value, "columns"):
+            self._dump(key, value, description)
+        if size > self.maxbytes:
+            with self._lock:
+                self._drop(key, files=False)
+            return
+        if hasattr(value, "copy"):
+            value = value.copy()
+        with self._lock:
+            self._drop(key, files=False)
+            self._entries[key] = (value, description, size, now)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self._drop(next(iter(self._entries)), files=False)
+
+    def clear(self):
+        """Remove all entries, from memory and from disk."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            if self.directory is None:
+                return
+            for name in os.listdir(self.directory):
+                if _RXP_FILE.match(name):
+                    _remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def _drop(self, key, files=True):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+        if files and self.directory is not None:
+            _remove(self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".parquet")
+
+    def _dump(self, key, dta, description):
+        """Write 'dta' to disk; silently skipped if Parquet cannot hold it."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(dta)
+            metadata = dict(table.schema.metadata or {})
+            metadata[_METADATA] = json.dumps(
+                [[c.name, c.type_code] for c in description or ()])
+            table = table.replace_schema_metadata(metadata)
+            tmp = self._path(key) + ".tmp"
+            pq.write_table(table, tmp)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            pass  # e.g. pyarrow missing, or columns of Python objects
+
+    def _load(self, key):
+        """Read an entry from disk and keep it in memory (None if missing)."""
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            stored = os.path.getmtime(path)
+        except OSError:
+            return None
+        if self._expired(stored):
+            _remove(path)
+            return None
+
+        try:
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+        except Exception:
+            return None
+        metadata = table.schema.metadata or {}
+        description = tuple(Column(*c) for c in
+                            json.loads(metadata.get(_METADATA, b"[]")))
+        dta = table.to_pandas()
+        size = _sizeof(dta)
+        if size <= self.maxbytes:
+            self._entries[key] = (dta, description, size, stored)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self._drop(next(iter(self._entries)), files=False)
+        return dta, description, size, stored
+
+
+class CachedCursor(object):
+    """Read-only stand-in for a client-side cursor, over cached rows."""
+
+    name = None
+    itersize = 2000
+
+    def __init__(self, rows, description):
+        """Create a cursor positioned before the first of 'rows'."""
+        self.description = description
+        self.rowcount = len(rows)
+        self.rownumber = 0
+        self.arraysize = 1
+        self.closed = False
+        self._rows = rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else int(size)
+        rows = self._rows[self.rownumber:self.rownumber + size]
+        self.rownumber += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self._rows) - self.rownumber)
+
+    def __iter__(self):
+        while self.rownumber < len(self._rows):
+            yield self.fetchone()
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _sizeof(value):
+    """Approximate memory used by a DataFrame or a list of rows (bytes)."""
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    size = sys.getsizeof(value)
+    for row in value:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    return size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
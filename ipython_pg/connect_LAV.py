@@ -6,9 +6,13 @@ HOST = "lav-fileserver"
 SSLCERT = os.path.join(os.path.expanduser("~"), "subnetz.org.crt")
 
 
-def connect(user=os.getlogin(), port=PORT, host=HOST, 
+def connect(user=None, port=PORT, host=HOST, 
             password=None, dbname=None, sslcert=SSLCERT):
-    """ Connect to a Postgres database server """
+    """ Connect to a Postgres database server (as the login user by default)
+    """
+
+    if user is None:
+        user = os.getlogin()
 
     if password is None:
         import getpass
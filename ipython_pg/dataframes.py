@@ -0,0 +1,335 @@
+""" Columnar construction of pandas DataFrames from psycopg2 cursors.
+
+    Rows are fetched batch by batch and each batch is transposed into one
+    typed NumPy array per column right away, so no list of row tuples for
+    the complete result is ever built. The dtype of a column is chosen from
+    its type code in 'cursor.description'; types without a native NumPy
+    representation are kept as Python objects.
+
+    Alternatively, 'copy_to_dataframe' pulls the results of a query through
+    'COPY ... TO STDOUT' and parses the CSV stream with pandas' C parser,
+    which avoids psycopg2's per-value typecasting altogether.
+    """
+
+from operator import itemgetter
+import io
+import numpy as np
+import pandas as pd
+import psycopg2.extensions
+
+from . import green_mode
+from . import stats
+
+# type OIDs of the built-in postgres types (see pg_type.dat)
+BOOL = 16
+BYTEA = 17
+NAME = 19
+INT8 = 20
+INT2 = 21
+INT4 = 23
+TEXT = 25
+JSON = 114
+FLOAT4 = 700
+FLOAT8 = 701
+BPCHAR = 1042
+VARCHAR = 1043
+DATE = 1082
+TIMESTAMP = 1114
+TIMESTAMPTZ = 1184
+NUMERIC = 1700
+JSONB = 3802
+
+# NumPy dtype per type OID; NULLs in integer and boolean columns are tracked
+# with a mask, NULLs in floating point and timestamp columns become NaN/NaT
+INTEGER_TYPES = {INT2: np.int16, INT4: np.int32, INT8: np.int64}
+FLOAT_TYPES = {FLOAT4: np.float32, FLOAT8: np.float64, NUMERIC: np.float64}
+NULLABLE_TYPES = {INT2: 'Int16', INT4: 'Int32', INT8: 'Int64', BOOL: 'boolean'}
+TEXT_TYPES = (NAME, TEXT, BPCHAR, VARCHAR)
+
+# NULL marker used for 'COPY ... TO STDOUT'
+COPY_NULL = "\\N"
+
+
+def cursor_to_dataframe(cur, batchsize=None, nullable=False):
+    """Fetch all remaining rows of 'cur' into a DataFrame.
+
+    Arguments:
+        cur {cursor} -- cursor holding the results of a query.
+        batchsize {int} -- rows to fetch and convert at once (default:
+                           the cursor's itersize).
+        nullable {bool} -- if True, integer and boolean columns always use
+                           pandas' nullable dtypes; otherwise only if they
+                           contain NULLs (default: False).
+
+    Returns:
+        pandas.DataFrame
+    """
+    if cur.name is None and cur.description is None:
+        return pd.DataFrame([])  # statement did not return any rows
+
+    batchsize = cur.itersize if batchsize is None else int(batchsize)
+    batches = []
+    nrows = 0
+    while True:
+        with stats.phase("fetch"), green_mode.cancellable(_connection(cur)):
+            rows = cur.fetchmany(batchsize)
+        if not rows:
+            break
+        nrows += len(rows)
+        with stats.phase("build"):
+            batches.append(_rows_to_columns(rows, cur.description))
+
+    if cur.description is None:
+        return pd.DataFrame([])
+    stats.count(rows=nrows)
+    with stats.phase("build"):
+        return columns_to_dataframe(batches, cur.description, nullable)
+
+
+def iter_dataframes(cur, chunksize=None, nullable=True):
+    """Fetch the remaining rows of 'cur' as a sequence of DataFrames.
+
+    Only one chunk of rows is held at a time, so with a server-side cursor
+    results of any size can be processed in constant memory.
+
+    Arguments:
+        cur {cursor} -- cursor holding the results of a query.
+        chunksize {int} -- rows per DataFrame (default: the cursor's
+                           itersize).
+        nullable {bool} -- see 'cursor_to_dataframe'; by default, integer
+                           and boolean columns use pandas' nullable dtypes,
+                           so that all chunks have the same dtypes whether or
+                           not they contain NULLs (default: True).
+
+    Yields:
+        pandas.DataFrame -- at least one, empty if there are no rows.
+    """
+    if cur.name is None and cur.description is None:
+        return  # statement did not return any rows
+
+    chunksize = cur.itersize if chunksize is None else int(chunksize)
+    empty = True
+    while True:
+        with stats.phase("fetch"), green_mode.cancellable(_connection(cur)):
+            rows = cur.fetchmany(chunksize)
+        if not rows:
+            if empty:
+                yield columns_to_dataframe([], cur.description, nullable)
+            return
+        empty = False
+        with stats.phase("build"):
+            columns = _rows_to_columns(rows, cur.description)
+            dta = columns_to_dataframe([columns], cur.description, nullable)
+        yield dta
+
+
+def _connection(cur):
+    """Connection of 'cur' (None for cursors over cached rows)."""
+    return getattr(cur, "connection", None)
+
+
+def columns_to_dataframe(batches, description, nullable=False):
+    """Assemble converted column batches into a single DataFrame.
+
+    Arguments:
+        batches {list} -- one list of (values, mask) pairs per batch, as
+                          returned by '_column_to_array'.
+        description {sequence} -- 'cursor.description' of the query.
+        nullable {bool} -- see 'cursor_to_dataframe'.
+    """
+    arrays = []
+    for i, col in enumerate(description):
+        parts = [b[i] for b in batches]
+        if not parts:
+            parts = [_column_to_array([], col.type_code)]
+        values = np.concatenate([p[0] for p in parts])
+        mask = (None if parts[0][1] is None
+                else np.concatenate([p[1] for p in parts]))
+        arrays.append(_finalize(values, mask, col.type_code, nullable))
+
+    dta = pd.DataFrame({i: a for i, a in enumerate(arrays)})
+    dta.columns = [c.name for c in description]
+    return dta
+
+
+def _rows_to_columns(rows, description):
+    """Convert a batch of rows to one (values, mask) pair per column."""
+    return [_column_to_array(list(map(itemgetter(i), rows)), c.type_code)
+            for i, c in enumerate(description)]
+
+
+def _column_to_array(values, type_code):
+    """Convert a list of values to a NumPy array and a NULL mask (or None)."""
+    n = len(values)
+    if type_code in INTEGER_TYPES or type_code == BOOL:
+        dtype = INTEGER_TYPES.get(type_code, np.bool_)
+        if None not in values:
+            return np.fromiter(values, dtype, n), np.zeros(n, np.bool_)
+        mask = np.fromiter((v is None for v in values), np.bool_, n)
+        values = (0 if v is None else v for v in values)
+        return np.fromiter(values, dtype, n), mask
+
+    try:
+        if type_code in FLOAT_TYPES:
+            return np.array(values, dtype=FLOAT_TYPES[type_code]), None
+        if type_code == TIMESTAMP:
+            return np.array(values, dtype='datetime64[us]'), None
+        if type_code == TIMESTAMPTZ:
+            values = pd.to_datetime(values, utc=True)
+            if hasattr(values, "as_unit"):  # else always nanoseconds
+                # the unit is inferred from the values, e.g. seconds if NULL
+                values = values.as_unit("us")
+            return values.tz_localize(None).values, None
+    except (TypeError, ValueError, OverflowError):
+        pass  # e.g. infinite timestamps: keep the Python objects
+
+    arr = np.empty(n, dtype=object)
+    arr[:] = values
+    return arr, None
+
+
+def _infer_string():
+    """Whether pandas infers the 'str' dtype for strings (from pandas 3)."""
+    try:
+        return pd.get_option("future.infer_string")
+    except KeyError:  # pandas < 2.1
+        return False
+
+
+def _finalize(values, mask, type_code, nullable=False):
+    """Wrap a concatenated column in the matching pandas array type."""
+    if values.dtype == object:
+        if type_code in TEXT_TYPES and _infer_string():
+            # the dtype pandas would infer, also if there are only NULLs
+            return pd.array(values, dtype="str")
+        return values
+    if mask is not None:
+        if not (nullable or mask.any()):
+            return values
+        if values.dtype == np.bool_:
+            return pd.arrays.BooleanArray(values, mask)
+        return pd.arrays.IntegerArray(values, mask)
+    if type_code == TIMESTAMPTZ:
+        return pd.DatetimeIndex(values, tz='UTC').array
+    return values
+
+
+def copy_to_dataframe(cur, sql, args=None, nullable=False):
+    """Fetch the results of 'sql' through COPY TO STDOUT into a DataFrame.
+
+    The query is first run with 'LIMIT 0' to learn the type of each column,
+    which determines the dtypes used to parse the CSV stream. Columns without
+    a native dtype are passed through psycopg2's typecasters, so they hold
+    the same Python objects as when fetched through the cursor. Ctrl-C
+    cancels the query (see 'green_mode').
+
+    Arguments:
+        cur {cursor} -- cursor to run the query with.
+        sql {str or SQL} -- query returning rows (no trailing semicolon).
+        args {sequence} -- query arguments, as for 'cursor.execute'.
+        nullable {bool} -- see 'cursor_to_dataframe'.
+
+    Returns:
+        tuple -- the DataFrame, and the description of its columns (COPY
+                 resets 'cur.description').
+    """
+    sql = cur.mogrify(sql, args).rstrip().rstrip(b";")
+    with stats.phase("execute"), green_mode.cancellable(cur.connection):
+        cur.execute(b"SELECT * FROM (" + sql + b") AS q LIMIT 0")
+    description = cur.description
+
+    buff = io.BytesIO()
+    with stats.phase("copy"), green_mode.cancellable(cur.connection):
+        cur.copy_expert(b"COPY (" + sql + b") TO STDOUT WITH (FORMAT csv, "
+                        b"NULL '" + COPY_NULL.encode() + b"')", buff)
+    stats.count(rows=cur.rowcount, nbytes=buff.tell())
+    buff.seek(0)
+    with stats.phase("parse"):
+        return csv_to_dataframe(buff, description, cur, nullable), description
+
+
+def csv_to_dataframe(buff, description, cur=None, nullable=False):
+    """Parse the output of 'COPY ... TO STDOUT WITH (FORMAT csv)'.
+
+    Arguments:
+        buff {file} -- file-like object holding the CSV data.
+        description {sequence} -- 'cursor.description' of the query.
+        cur {cursor} -- cursor whose typecasters to use (default: None).
+        nullable {bool} -- see 'cursor_to_dataframe'.
+    """
+    dtypes, na_values = {}, {}
+    for i, col in enumerate(description):
+        na_values[i] = [COPY_NULL]
+        if col.type_code in FLOAT_TYPES:
+            dtypes[i] = FLOAT_TYPES[col.type_code]
+            na_values[i].append("NaN")
+        elif col.type_code not in NULLABLE_TYPES:
+            dtypes[i] = object
+    # integers and booleans are left to the parser's own inference, because
+    # it is much faster than parsing into pandas' nullable dtypes
+    options = dict(header=None, na_values=na_values, keep_default_na=False,
+                   true_values=["t"], false_values=["f"])
+
+    try:
+        dta = pd.read_csv(buff, names=list(range(len(description))),
+                          dtype=dtypes, **options)
+    except pd.errors.EmptyDataError:
+        return columns_to_dataframe([], description, nullable)
+
+    arrays = []
+    for i, col in enumerate(description):
+        values = dta[i]
+        if (col.type_code == INT8 and values.dtype.kind == "f"
+                and values.abs().max() >= 2 ** 53):
+            # got NULLs and values float64 cannot hold exactly: parse again
+            buff.seek(0)
+            values = pd.read_csv(buff, usecols=[i], dtype={i: "Int64"},
+                                 **options)[i]
+        arrays.append(_convert_csv_column(values, col.type_code, cur,
+                                          nullable))
+
+    dta = pd.DataFrame({i: a for i, a in enumerate(arrays)})
+    dta.columns = [c.name for c in description]
+    return dta
+
+
+def _convert_csv_column(values, type_code, cur=None, nullable=False):
+    """Convert a column parsed by 'pandas.read_csv' like a fetched one."""
+    if type_code in NULLABLE_TYPES:
+        mask = values.isna().to_numpy()
+        dtype = INTEGER_TYPES.get(type_code, np.bool_)
+        if mask.any():
+            values = values.fillna(0)
+        # straight to the dtype: Int64 columns would go through float64
+        return _finalize(values.to_numpy(dtype=dtype), mask, type_code,
+                         nullable)
+    if type_code in FLOAT_TYPES:
+        return values.to_numpy()
+
+    if type_code in (TIMESTAMP, TIMESTAMPTZ):
+        try:
+            values = pd.to_datetime(values, format="ISO8601",
+                                    utc=type_code == TIMESTAMPTZ)
+        except (ValueError, OverflowError):
+            pass  # e.g. infinite timestamps: use the typecaster
+        else:
+            return values.array
+
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values.to_numpy(dtype=object, na_value=None)
+    caster = _typecaster(type_code, cur)
+    if caster is not None and type_code not in TEXT_TYPES:
+        arr[:] = [None if v is None else caster(v, cur) for v in arr]
+    return arr
+
+
+def _typecaster(type_code, cur=None):
+    """Return the psycopg2 typecaster in effect for 'type_code' (or None)."""
+    scopes = []
+    if cur is not None:
+        scopes = [cur.string_types, cur.connection.string_types]
+    scopes.append(psycopg2.extensions.string_types)
+    for scope in scopes:
+        if scope and type_code in scope:
+            return scope[type_code]
+    return None
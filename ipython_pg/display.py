@@ -0,0 +1,160 @@
+""" Paginated HTML display of query results.
+
+    A 'ResultPager' shows the rows of a cursor one page at a time. Rows are
+    fetched from the cursor only when a page needs them (plus one row, to
+    know whether there is a next page), so looking at the beginning of a
+    large result neither renders nor, with a server-side cursor, transfers
+    the rest of it. Rows already fetched are kept, to go back.
+
+    Each page is rendered column by column: the values of a column are
+    formatted and escaped in one pass, before the rows are assembled.
+    """
+
+from html import escape
+import psycopg2
+
+from . import green_mode
+from . import stats
+
+
+class ResultPager(object):
+    """Page through the rows of a cursor.
+
+    In a notebook, the pager shows its current page; 'next', 'prev' and
+    'page' move to another page and return the pager, so that it is shown
+    again. 'widget' returns an interactive version with buttons (requires
+    ipywidgets).
+    """
+
+    def __init__(self, cur, page_size=500):
+        """Create a pager positioned on the first page.
+
+        Arguments:
+            cur {cursor} -- cursor holding the results; server-side cursors
+                            must stay open (i.e. their transaction must not
+                            end) while pages are fetched.
+            page_size {int} -- number of rows per page (default: 500).
+        """
+        self.cur = cur
+        self.page_size = max(int(page_size), 1)
+        self.current = 0
+        self.error = None
+        self._rows = []
+        self._done = False
+        self._html = None  # (state, html) of the last page rendered
+
+    @property
+    def columns(self):
+        # server-side cursors only know their columns after the first fetch
+        self._fetch(0)
+        return [c[0] for c in self.cur.description or ()]
+
+    def _fetch(self, n):
+        """Fetch the rows of page 'n' and the first row after it."""
+        needed = (n + 1) * self.page_size + 1 - len(self._rows)
+        if self._done or needed <= 0:
+            return
+        try:
+            with stats.phase("fetch"), green_mode.cancellable(
+                    getattr(self.cur, "connection", None)):
+                rows = self.cur.fetchmany(needed)
+        except psycopg2.Error as e:
+            # e.g. the transaction of a server-side cursor has ended
+            self.error = str(e).strip()
+            rows = []
+        self._rows.extend(rows)
+        self._done = len(rows) < needed
+
+    @property
+    def pages(self):
+        """Number of pages fetched so far (all of them if 'complete')."""
+        return -(-len(self._rows) // self.page_size)
+
+    @property
+    def complete(self):
+        """True if all rows have been fetched."""
+        return self._done
+
+    def page(self, n):
+        """Move to page 'n' (counting from 0) and return the pager."""
+        n = max(int(n), 0)
+        self._fetch(n)
+        self.current = min(n, max(self.pages - 1, 0))
+        return self
+
+    def next(self):
+        """Move to the next page, if any."""
+        return self.page(self.current + 1)
+
+    def prev(self):
+        """Move to the previous page, if any."""
+        return self.page(self.current - 1)
+
+    def rows(self):
+        """Return the rows of the current page."""
+        self._fetch(self.current)
+        first = self.current * self.page_size
+        return self._rows[first:first + self.page_size]
+
+    def footer(self):
+        """Describe the position of the current page in the results."""
+        rows = self.rows()
+        if not rows:
+            text = "(no results to display)"
+        else:
+            first = self.current * self.page_size
+            text = "rows {} to {} of {}".format(
+                first + 1, first + len(rows),
+                len(self._rows) if self._done else "more")
+            if first + len(rows) < len(self._rows):
+                text += " (call .next() for the next page)"
+        if self.error:
+            text += "; fetching stopped: {}".format(self.error)
+        return text
+
+    def _repr_html_(self):
+        columns = self.columns
+        state = (self.current, len(self._rows), self._done)
+        if self._html is None or self._html[0] != state:
+            with stats.phase("render"):
+                html = _html_table(columns, self.rows(), self.footer())
+            self._html = (state, html)
+        return self._html[1]
+
+    def __repr__(self):
+        return "<ResultPager: page {} of {}{}>".format(
+            self.current + 1, max(self.pages, 1),
+            "" if self._done else "+")
+
+    def widget(self):
+        """Return an ipywidgets box with buttons to move between pages."""
+        import ipywidgets
+
+        html = ipywidgets.HTML(self._repr_html_())
+        prev = ipywidgets.Button(description="previous")
+        nxt = ipywidgets.Button(description="next")
+
+        def move(step):
+            def handler(button):
+                self.page(self.current + step)
+                html.value = self._repr_html_()
+            return handler
+
+        prev.on_click(move(-1))
+        nxt.on_click(move(1))
+        return ipywidgets.VBox([ipywidgets.HBox([prev, nxt]), html])
+
+
+def _html_table(columns, rows, footer=""):
+    """Render 'rows' as HTML table, formatting one column at a time."""
+    cells = [["<td>{}</td>".format(escape(str(v))) for v in values]
+             for values in zip(*rows)]
+
+    html = ['<table width="100%">', "<thead><tr>"]
+    html.extend("<th>{}</th>".format(escape(str(c))) for c in columns)
+    html.append("</tr></thead><tbody>")
+    html.extend("<tr>{}</tr>".format("".join(row)) for row in zip(*cells))
+    html.append("</tbody></table>")
+    if footer:
+        html.append("<p><small>{}</small></p>".format(escape(footer)))
+    return "".join(html)
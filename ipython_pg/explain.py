@@ -0,0 +1,165 @@
+""" Parse query plans from 'EXPLAIN (FORMAT JSON)' into DataFrames.
+
+    Each node of a plan becomes one row of a DataFrame. Its position in the
+    tree is given by 'path' (the indices of the node and its ancestors among
+    their siblings, e.g. '0.1.0'), which also lines nodes up when two plans of
+    the same query are compared (see 'diff').
+
+    With ANALYZE, times are inclusive of the children and multiplied by the
+    number of loops; 'self_ms' is the part of a node's time not spent in its
+    children. Nodes taking at least 'HOT_SHARE' of the execution time by
+    themselves are flagged as 'hot'.
+    """
+
+import datetime
+import json
+import pandas as pd
+
+# share of the execution time that makes a node hot
+HOT_SHARE = 0.2
+
+# columns of the DataFrames of nodes (besides 'path' and 'node')
+COLUMNS = ["depth", "parent", "relation", "index", "startup_ms", "total_ms",
+           "self_ms", "self_share", "hot", "loops", "plan_rows",
+           "actual_rows", "rows_error", "shared_hit", "shared_read",
+           "shared_dirtied", "shared_written", "temp_read", "temp_written",
+           "cost"]
+
+# columns compared by 'diff'
+DIFF_COLUMNS = ["total_ms", "self_ms", "actual_rows", "rows_error",
+                "shared_hit", "shared_read", "cost"]
+
+
+class Plan(object):
+    """Query plan of one run of 'EXPLAIN (FORMAT JSON)'."""
+
+    def __init__(self, raw, sql=None):
+        """Parse a plan.
+
+        Arguments:
+            raw {list or str} -- output of 'EXPLAIN (FORMAT JSON)'.
+            sql {str} -- the explained query (default: None).
+        """
+        if isinstance(raw, str):
+            raw = json.loads(raw)
+        self.raw = raw[0] if isinstance(raw, list) else raw
+        self.sql = sql
+        self.created = datetime.datetime.now()
+        self.planning_ms = self.raw.get("Planning Time")
+        self.execution_ms = self.raw.get("Execution Time")
+        self.nodes = plan_to_dataframe(self.raw, self.execution_ms)
+
+    def hottest(self, n=3):
+        """Return the 'n' nodes taking the most time by themselves."""
+        return self.nodes.sort_values("self_ms", ascending=False).head(n)
+
+    def summary(self):
+        """Return a one-line summary of timings and the hottest node."""
+        parts = []
+        if self.planning_ms is not None:
+            parts.append("planning {:.3f} ms".format(self.planning_ms))
+        if self.execution_ms is not None:
+            parts.append("execution {:.3f} ms".format(self.execution_ms))
+            top = self.hottest(1)
+            if len(top) and top["self_share"].notna().all():
+                parts.append("hottest: {} ({:.0%})"
+                             .format(top["node"].iloc[0],
+                                     top["self_share"].iloc[0]))
+        if not parts:
+            parts.append("estimated cost {:.2f}"
+                         .format(self.raw["Plan"].get("Total Cost", 0)))
+        return ", ".join(parts)
+
+    def __repr__(self):
+        return "{}\n{}".format(self.summary(), self.nodes.to_string())
+
+    def _repr_html_(self):
+        return "<p>{}</p>{}".format(self.summary(), self.nodes.to_html())
+
+
+def plan_to_dataframe(raw, execution_ms=None):
+    """Flatten the nodes of a plan into a DataFrame (one row per node).
+
+    Arguments:
+        raw {dict} -- top-level object of 'EXPLAIN (FORMAT JSON)'.
+        execution_ms {float} -- execution time, used for 'self_share'
+                                (default: None).
+    """
+    rows = []
+    _walk(raw["Plan"], "0", None, 0, rows)
+
+    dta = pd.DataFrame(rows, columns=["path", "node"] + COLUMNS)
+    if execution_ms:
+        dta["self_share"] = dta["self_ms"] / execution_ms
+        dta["hot"] = dta["self_share"] >= HOT_SHARE
+    return dta.set_index("path")
+
+
+def _walk(node, path, parent, depth, rows):
+    """Append 'node' and its children to 'rows', returning its total time."""
+    label = node["Node Type"]
+    relation = node.get("Relation Name")
+    index = node.get("Index Name")
+    if relation is not None:
+        label += " on {}".format(relation)
+    elif index is not None:
+        label += " using {}".format(index)
+
+    loops = node.get("Actual Loops")
+    total = startup = actual = None
+    if loops is not None:
+        startup = node["Actual Startup Time"]
+        total = node["Actual Total Time"] * loops
+        actual = node["Actual Rows"] * loops
+
+    row = dict(path=path, node=label, depth=depth, parent=parent,
+               relation=relation, index=index, startup_ms=startup,
+               total_ms=total, loops=loops,
+               plan_rows=node.get("Plan Rows"), actual_rows=actual,
+               shared_hit=node.get("Shared Hit Blocks"),
+               shared_read=node.get("Shared Read Blocks"),
+               shared_dirtied=node.get("Shared Dirtied Blocks"),
+               shared_written=node.get("Shared Written Blocks"),
+               temp_read=node.get("Temp Read Blocks"),
+               temp_written=node.get("Temp Written Blocks"),
+               cost=node.get("Total Cost"))
+    if loops:
+        # estimates are per loop; > 1 means more rows than estimated
+        row["rows_error"] = (node["Actual Rows"]
+                             / max(node.get("Plan Rows", 0), 1))
+    rows.append(row)
+
+    children = 0.0
+    for i, child in enumerate(node.get("Plans", ())):
+        child_total = _walk(child, "{}.{}".format(path, i), path, depth + 1,
+                            rows)
+        children += child_total or 0.0
+    if total is not None:
+        row["self_ms"] = max(total - children, 0.0)
+    return total
+
+
+def diff(before, after):
+    """Compare two plans of a query node by node.
+
+    Nodes are matched on their position in the tree and their label; nodes
+    only found in one plan have missing values for the other.
+
+    Arguments:
+        before {Plan} -- plan to compare against.
+        after {Plan} -- the new plan.
+
+    Returns:
+        pandas.DataFrame -- for every column in 'DIFF_COLUMNS', its value
+                            before and after, and the change of the times.
+    """
+    left = before.nodes.reset_index()[["path", "node"] + DIFF_COLUMNS]
+    right = after.nodes.reset_index()[["path", "node"] + DIFF_COLUMNS]
+    dta = left.merge(right, on=["path", "node"], how="outer",
+                     suffixes=("_before", "_after"))
+    for col in ("total_ms", "self_ms"):
+        dta[col + "_change"] = dta[col + "_after"] - dta[col + "_before"]
+    dta["path_key"] = dta["path"].map(
+        lambda p: tuple(int(i) for i in p.split(".")))
+    dta = dta.sort_values(["path_key", "node"]).drop(columns="path_key")
+    return dta.set_index(["path", "node"])
@@ -0,0 +1,195 @@
+""" Export of query results to files, one batch at a time.
+
+    CSV files are written by 'COPY ... TO STDOUT' straight from the server,
+    without parsing the data. Parquet and Arrow (Feather) files are written
+    from DataFrames of a fixed number of rows, fetched one after another
+    through a server-side cursor (see 'dataframes.iter_dataframes'), so at
+    most one batch is held in memory. Both formats require 'pyarrow'.
+
+    Files are written under a temporary name next to the target, which they
+    only replace once complete: a failed export leaves no truncated file.
+    """
+
+from contextlib import contextmanager
+import gzip
+import json
+import os
+
+from . import green_mode
+from . import stats
+
+# file formats, by file extension
+FORMATS = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow",
+           ".feather": "arrow", ".ipc": "arrow", ".csv": "csv"}
+
+# type codes of json and jsonb (as in 'dataframes', which imports pandas)
+_JSON_TYPES = (114, 3802)
+
+# compression codecs supported per format
+COMPRESSION = {"parquet": ("snappy", "gzip", "brotli", "zstd", "lz4", "none"),
+               "arrow": ("lz4", "zstd", "none"),
+               "csv": ("gzip", "none")}
+
+
+def guess_format(path, default="parquet"):
+    """Return the format of a file from its extension."""
+    path = path[:-3] if path.endswith(".gz") else path
+    return FORMATS.get(os.path.splitext(path)[1].lower(), default)
+
+
+def copy_to_csv(cur, sql, path, args=None, compression=None):
+    """Write the results of 'sql' to a CSV file (with header) using COPY.
+
+    Ctrl-C cancels the COPY (see 'green_mode').
+
+    Arguments:
+        cur {cursor} -- cursor to run the query with.
+        sql {str or SQL} -- query returning rows (no trailing semicolon).
+        path {str} -- file to write.
+        args {sequence} -- query arguments, as for 'cursor.execute'.
+        compression {str} -- 'gzip' or 'none' (default: 'gzip' if 'path'
+                             ends with '.gz', else 'none').
+
+    Returns:
+        int -- number of rows written.
+    """
+    sql = cur.mogrify(sql, args).rstrip().rstrip(b";")
+    if compression is None and path.endswith(".gz"):
+        compression = "gzip"
+    opener = gzip.open if compression == "gzip" else open
+    with _replacing(path) as tmp:
+        with opener(tmp, "wb") as f, stats.phase("copy"), \
+                green_mode.cancellable(cur.connection):
+            cur.copy_expert(b"COPY (" + sql + b") TO STDOUT WITH (FORMAT "
+                            b"csv, HEADER)", f)
+            nbytes = f.tell()
+    stats.count(rows=cur.rowcount, nbytes=nbytes)
+    return cur.rowcount
+
+
+def write_frames(frames, path, format="parquet", compression=None,
+                 row_group_size=None, description=None):
+    """Write a sequence of DataFrames with the same columns to one file.
+
+    The type of a column is taken from 'description' where its type code
+    has a fixed Arrow type (see '_arrow_types'), else from the first
+    DataFrame; columns that only hold NULLs there are assumed to be text.
+    JSON columns are written as text.
+
+    Arguments:
+        frames {iterable} -- DataFrames to write, e.g. from
+                            'dataframes.iter_dataframes'.
+        path {str} -- file to write.
+        format {str} -- 'parquet' or 'arrow' (default: 'parquet').
+        compression {str} -- codec, see 'COMPRESSION' (default: snappy for
+                             Parquet, 'none' for Arrow).
+        row_group_size {int} -- maximum rows per Parquet row group, or per
+                                Arrow record batch (default: one per
+                                DataFrame).
+        description {sequence} -- 'cursor.description' of the query the
+                                  DataFrames hold the results of (default:
+                                  None).
+
+    Returns:
+        int -- number of rows written.
+    """
+    import pyarrow as pa
+
+    if format == "parquet" and compression is None:
+        compression = "snappy"
+    writer = schema = None
+    nrows = 0
+    json_columns = [i for i, col in enumerate(description or ())
+                    if col.type_code in _JSON_TYPES]
+    with _replacing(path) as tmp:
+        try:
+            for dta in frames:
+                with stats.phase("write"):
+                    if json_columns:
+                        dta = dta.copy(deep=False)
+                        for i in json_columns:
+                            dta.isetitem(i, [None if v is None
+                                             else json.dumps(v)
+                                             for v in dta.iloc[:, i]])
+                    if schema is None:
+                        schema = _schema(pa.Table.from_pandas(
+                            dta, preserve_index=False).schema, description)
+                        writer = _writer(tmp, schema, format, compression)
+                    table = pa.Table.from_pandas(dta, schema=schema,
+                                                 preserve_index=False)
+                    if format == "parquet":
+                        writer.write_table(table,
+                                           row_group_size=row_group_size)
+                    else:
+                        writer.write_table(table,
+                                           max_chunksize=row_group_size)
+                nrows += len(dta)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            raise ValueError("no DataFrames to write")
+        nbytes = os.path.getsize(tmp)
+    stats.count(rows=nrows, nbytes=nbytes)
+    return nrows
+
+
+@contextmanager
+def _replacing(path):
+    """Yield a temporary path to write instead of 'path'; move the file onto
+    'path' if the block succeeds, else remove it."""
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, ".{}.{}.part".format(name, os.getpid()))
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def _schema(schema, description=None):
+    """Set the types of the columns whose type codes have a fixed Arrow type,
+    and of the remaining ones of unknown type (all NULL) to text."""
+    import pyarrow as pa
+
+    types = _arrow_types()
+    for i, field in enumerate(schema):
+        typ = None
+        if description is not None:
+            typ = types.get(description[i].type_code)
+        if typ is None and pa.types.is_null(field.type):
+            typ = pa.string()
+        if typ is not None:
+            schema = schema.set(i, field.with_type(typ))
+    return schema
+
+
+def _arrow_types():
+    """Return the Arrow type of columns per type code, as converted by
+    'dataframes.iter_dataframes'."""
+    import pyarrow as pa
+    from . import dataframes as d
+
+    types = {d.BOOL: pa.bool_(), d.INT2: pa.int16(), d.INT4: pa.int32(),
+             d.INT8: pa.int64(), d.FLOAT4: pa.float32(),
+             d.FLOAT8: pa.float64(), d.NUMERIC: pa.float64(),
+             d.DATE: pa.date32(), d.TIMESTAMP: pa.timestamp("us"),
+             d.TIMESTAMPTZ: pa.timestamp("us", tz="UTC")}
+    types.update((code, pa.string()) for code in d.TEXT_TYPES)
+    return types
+
+
+def _writer(path, schema, format, compression):
+    import pyarrow as pa
+
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema, compression=compression)
+    if format == "arrow":
+        if compression == "none":
+            compression = None
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        return pa.ipc.new_file(path, schema, options=options)
+    raise ValueError("unknown export format '{}'".format(format))
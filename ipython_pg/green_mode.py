@@ -1,25 +1,68 @@
 """Enables aborting long-running queries in interactive shells.
 
-By introducing a 'wait_callback'
-(see http://initd.org/psycopg/docs/extras.html - Coroutine support),
-the interpreter retains control and listens for KeyboardInterrupts.
-If one occurs, the callback cancels the current transaction using the connction
-after which control is returned to the shell.
+Statements that may take long are run inside 'cancellable(conn)', which
+registers the connection for the duration of the operation. If Ctrl-C is
+pressed meanwhile, a watcher thread cancels the statements of all registered
+connections right away, i.e. while the main thread is still blocked in
+libpq. The statements then fail with 'QueryCanceledError', which is handled
+like any other error (e.g. the transaction is rolled back). Without a
+registered connection, Ctrl-C raises KeyboardInterrupt as usual.
 
-DEPENDENCY: only works with psycopg 2.2.0 or newer.
+Nothing is set for the whole process, as it was with the wait callback
+(see http://initd.org/psycopg/docs/extras.html - Coroutine support) this
+module used to register: COPY, which does not work with a wait callback, can
+be cancelled as well, and statements of other threads and connections run
+unaffected. Ctrl-C is only routed to the watcher thread (through
+'signal.set_wakeup_fd') while the main thread is inside 'cancellable'.
+Outside of it, the SIGINT handler installed on first use passes interrupts
+on to the handler it replaced, until 'deactivate' restores that one;
+connections registered by other threads, e.g. the workers of
+'%pg_copy --jobs', are cancelled along with the ones of the main thread,
+unless they are 'detached' (e.g. background queries).
 
 Author: Gil Georges <gil.georges@lav.mavt.ethz.ch>
 Date: November 23, 2016
 """
+from contextlib import contextmanager
+import os
+import signal
+import socket
+import threading
+import psycopg2
 import psycopg2.extensions
 from select import select
+try:
+    # the same without converting to enums, which takes longer than a query
+    from _signal import getsignal as _getsignal
+except ImportError:
+    _getsignal = signal.getsignal
 
 _WAIT_SELECT_TIMEOUT = 1
 
+_active = False
+_lock = threading.Lock()
+_local = threading.local()
+_conns = []  # (connection, on_cancel) of the statements Ctrl-C cancels
+
+# state of the main thread, while inside 'cancellable'
+_depth = 0
+_wakeup = None  # wakeup fd to restore
+_handler = None  # SIGINT handler replaced by '_on_interrupt'
+# interrupts that cancelled statements, as counted by the watcher and by the
+# SIGINT handler (whichever sees an interrupt first decides); each counter
+# has a single writer, as the handler must not wait for a lock: it runs
+# between any two bytecodes of the main thread, which may hold it
+_cancels = 0
+_handled = 0
+_watcher = None  # socket the watcher thread receives signal numbers on
+
 
 def wait_select(conn):
     """Monitor long-running queries and cancle on KeyboardInterrupt.
 
+    A wait callback for 'psycopg2.extensions.set_wait_callback', which is no
+    longer registered by 'activate'.
+
     Copied from http://initd.org/psycopg/articles/2014/07/20/cancelling-postgresql-statements-python/
     """
     while 1:
@@ -31,31 +74,184 @@ def wait_select(conn):
                 select([conn.fileno()], [], [], _WAIT_SELECT_TIMEOUT)
             elif state == psycopg2.extensions.POLL_WRITE:
                 select([], [conn.fileno()], [], _WAIT_SELECT_TIMEOUT)
-            else:
-                raise conn.OperationalError(
-                    "bad state from poll: %s" % state)
         except KeyboardInterrupt:
             conn.cancel()
             # the loop will be broken by a server error
             continue
 
 
-def activate():
-    """Register callback to activate interrupt support."""
-    try:
-        callback = psycopg2.extras.wait_select
-    except AttributeError:
-        callback = wait_select
+def cancellable(conn, on_cancel=None):
+    """Cancel the statement running on 'conn' if Ctrl-C is pressed.
 
-    try:
-        psycopg2.extensions.set_wait_callback(callback)
-    except AttributeError:
-        raise NotImplementedError("only works with psycopg 2.2.0 or newer")
+    Returns a context manager, to enclose the statement with. Can be used in
+    any thread, and nested.
 
-def deactivate():
-    """Deactivate green-mode."""
+    Arguments:
+        conn {connection} -- connection to cancel; None to only catch
+                             Ctrl-C, e.g. while waiting for other threads
+                             that register their connections.
+        on_cancel {callable} -- called (in the watcher thread) after
+                                cancelling, e.g. to stop feeding a COPY,
+                                which the client would otherwise send to
+                                the end (default: None).
+    """
+    return _Registration(conn, on_cancel)
+
+
+class _Registration(object):
+    """Registration of a connection by 'cancellable'.
+
+    A class rather than a generator, as it encloses every single query.
+    """
+
+    __slots__ = ("entry", "routed")
+
+    def __init__(self, conn, on_cancel):
+        self.entry = (conn, on_cancel)
+        self.routed = False
+
+    def __enter__(self):
+        global _depth
+        if getattr(_local, "detached", False):
+            self.entry = (None, None)
+            return None
+        self.routed = (_active and threading.current_thread()
+                       is threading.main_thread())
+        if self.routed:
+            if _depth == 0:
+                _route_interrupts()
+            _depth += 1
+        if self.entry[0] is not None:
+            with _lock:
+                _conns.append(self.entry)
+        return self.entry[0]
+
+    def __exit__(self, *exc):
+        global _depth
+        if self.entry[0] is not None:
+            with _lock:
+                _conns.remove(self.entry)
+        if self.routed:
+            _depth -= 1
+            if _depth == 0:
+                _restore_interrupts()
+
+
+@contextmanager
+def detached():
+    """Ignore 'cancellable' in the enclosed block, in this thread only.
+
+    For statements that Ctrl-C is not meant to cancel, e.g. those of
+    background queries.
+    """
+    previous = getattr(_local, "detached", False)
+    _local.detached = True
     try:
-        psycopg2.extensions.set_wait_callback(None)
-    except AttributeError:
-        raise NotImplementedError("only works with psycopg 2.2.0 or newer")
+        yield
+    finally:
+        _local.detached = previous
+
+
+def cancel():
+    """Cancel the statements of all registered connections.
 
+    Returns:
+        int -- the number of connections cancelled.
+    """
+    with _lock:
+        entries = list(_conns)
+    for conn, on_cancel in entries:
+        try:
+            conn.cancel()
+        except psycopg2.Error:
+            pass  # e.g. closed in the meantime
+        if on_cancel is not None:
+            on_cancel()
+    return len(entries)
+
+
+def _route_interrupts():
+    global _handled, _handler, _wakeup
+    _handled = _cancels
+    _wakeup = signal.set_wakeup_fd(_watcher_socket().fileno(),
+                                   warn_on_full_buffer=False)
+    # reinstalling the handler takes longer than running a short query, so
+    # it is left in place, unless replaced in the meantime (e.g. IPython
+    # kernels install theirs for each cell)
+    if _getsignal(signal.SIGINT) is not _on_interrupt:
+        _handler = signal.signal(signal.SIGINT, _on_interrupt)
+
+
+def _restore_interrupts():
+    global _wakeup
+    signal.set_wakeup_fd(_wakeup)
+    _wakeup = None
+
+
+def _on_interrupt(signum, frame):
+    """Handle SIGINT in the main thread; the watcher does the cancelling."""
+    global _handled
+    if _depth > 0 and (_cancels > _handled or _conns):
+        _handled += 1
+        return  # the statements fail with QueryCanceledError
+    handler = _handler
+    if handler is None:  # not installed from Python
+        handler = signal.default_int_handler
+    if callable(handler):
+        handler(signum, frame)
+    elif handler != signal.SIG_IGN:
+        raise KeyboardInterrupt
+
+
+def _watcher_socket():
+    """Return the socket to pass to 'set_wakeup_fd', starting the watcher."""
+    global _watcher
+    if _watcher is None:
+        receiver, sender = socket.socketpair()
+        sender.setblocking(False)
+        threading.Thread(target=_watch, args=(receiver,), daemon=True,
+                         name="ipython_pg_interrupts").start()
+        _watcher = sender
+    return _watcher
+
+
+def _watch(receiver):
+    while True:
+        try:
+            signals = receiver.recv(64)
+        except OSError:
+            return
+        if not signals:
+            return
+        wakeup = _wakeup
+        if wakeup is not None and wakeup >= 0:
+            try:
+                os.write(wakeup, signals)  # e.g. of an event loop
+            except OSError:
+                pass
+        if signal.SIGINT in signals:
+            _interrupted()
+
+
+def _interrupted():
+    global _cancels
+    if _handled > _cancels or _conns:
+        _cancels += 1
+        cancel()
+    # else the SIGINT handler raises KeyboardInterrupt
+
+
+def activate():
+    """Cancel the statements in 'cancellable' blocks on Ctrl-C."""
+    global _active
+    _active = True
+
+
+def deactivate():
+    """Deactivate green-mode: Ctrl-C raises KeyboardInterrupt only."""
+    global _active
+    _active = False
+    if (threading.current_thread() is threading.main_thread()
+            and signal.getsignal(signal.SIGINT) is _on_interrupt):
+        signal.signal(signal.SIGINT, _handler if _handler is not None
+                      else signal.default_int_handler)
@@ -19,26 +19,35 @@
          the cursor holding the query's results will be made available
          within the IPython session under the variable <varname>. If
          ommitted (only when used with the cell-magic), the results
-         are reproduced as an HTML table. Be careful here, very large
-         result sets may crash the display tool (console/browser).
+         are reproduced as an HTML table, 500 rows per page.
 
     Installation:
 
     """
 
 
+from collections import OrderedDict
 from contextlib import contextmanager
+import datetime
+import functools
+import importlib.util
+import itertools
+import math
 import re
 import getpass
 from IPython.core.magic import (Magics, line_magic, line_cell_magic,
                                 cell_magic, magics_class)
-from IPython.display import HTML
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
 import psycopg2.sql
-import pandas as pd
-import io
 import argparse
+from . import display
+from . import export
+from . import green_mode
+from . import stats
+from .cache import ResultCache, CachedCursor
+from .pool import ConnectionPool
 
 SQL_SCHEMAS = ("select n.nspname as name, "
                "coalesce(pg_catalog.obj_description(n.oid), "
@@ -71,12 +80,74 @@ SQL_COLUMNS = ("select column_name as name,"
                ")::regclass::oid) as oid from information_schema.columns "
                "where table_schema = '{}' and table_name='{}') as foo;")
 
+# statements that can run through a server-side (named) cursor
+RXP_QUERY = re.compile(r"^\s*(\(\s*)*(select|values|table|with)\b", re.I)
+
+# statements that can be prepared automatically (see 'pgMagics.query')
+RXP_PREPARABLE = re.compile(r"^\s*(\(\s*)*(select|values|table|with|insert|"
+                            r"update|delete)\b", re.I)
+
+# statements that may deallocate prepared statements
+RXP_DEALLOCATE = re.compile(r"^\s*(deallocate|discard)\b", re.I)
+
+# '$<n>' parameters of prepared statements (group 2), after the literals,
+# quoted identifiers and comments they may appear in (left as they are)
+RXP_SQL_PARAMETER = re.compile(
+    r"(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\""
+    r"|(\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$).*?\1|--[^\n]*|/\*.*?\*/"
+    r"|\$([1-9][0-9]*)", re.S)
+
+# '${<expr>}' or '${<expr>:<fmt>}' in queries, but not '$${...}'
+RXP_TEMPLATE = re.compile(r"(?<!\$)\${([^}:]*)(?::([sia]))?}")
+
+# stands for the '%s' of a query argument in a compiled template
+_PLACEHOLDER = psycopg2.sql.SQL("%s")
+
+# sequence used to generate unique names for server-side cursors
+_CURSOR_IDS = itertools.count()
+
+# sequence used to generate unique names for automatically prepared
+# statements
+_STATEMENT_IDS = itertools.count()
+
+# types of the literals psycopg2 renders arguments of these types as (see
+# '_parameter_type'); 'unknown' ones are typed by the statement
+_LITERAL_TYPES = {type(None): "unknown", bool: "boolean", str: "unknown",
+                  float: "numeric", bytes: "bytea", datetime.date: "date",
+                  datetime.timedelta: "interval"}
+
+# name of the connection opened by '%pg_connect' without '--name'
+DEFAULT_CONNECTION = "default"
+
+# number of bytes 'copy_expert' reads from its source at once
+COPY_BUFFER_SIZE = 1 << 16
+
+
+def _recorded(func):
+    """Record the timings of a magic in the history (see 'stats').
+
+    The breakdown is printed afterwards if the magic enabled profiling
+    (see '_profile').
+    """
+    @functools.wraps(func)
+    def wrapper(self, line, cell=None, **kwargs):
+        sql = line if cell is None else cell
+        with stats.record(self.history, func.__name__, sql) as rec:
+            result = func(self, line, cell, **kwargs)
+        if getattr(rec, "profile", False):
+            self.shell.write(rec.report())
+        return result
+    return wrapper
+
+
 @magics_class
 class pgMagics(Magics):
 
     def __init__(self, shell, default_host="localhost", default_port=5432,
                  default_sslcert=None, default_user=None, auto_commit=True,
-                 disable_postgis_integration=False, disable_green_mode=False):
+                 disable_postgis_integration=False, disable_green_mode=False,
+                 stream=False, itersize=2000, pool_size=4, auto_prepare=None,
+                 max_prepared=64):
         """Create a new pgMagic instance.
 
         Arguments:
@@ -93,9 +164,33 @@ class pgMagics(Magics):
             auto_commit {bool} -- if True, commit when queries with row-count
                                   -1 are executed (queries that create objects
                                   such as tables and view) (default: True).
+            stream {bool} -- if True, queries fetch their results through a
+                             server-side cursor in batches of 'itersize'
+                             rows, instead of loading the whole result set
+                             into memory at once (default: False).
+            itersize {int} -- number of rows fetched per round trip when
+                              streaming results (default: 2000).
+            pool_size {int} -- number of idle connections kept open per
+                               named connection, for background work such
+                               as parallel copies and queries run with
+                               '--async'; also the number of queries that
+                               run in the background at once (default: 4).
+            auto_prepare {int} -- if set, statements with '${...}'
+                                  arguments are prepared on the server once
+                                  they have run this many times (with
+                                  arguments of the same types) on a
+                                  connection, and executed as prepared
+                                  statements from then on, so they are
+                                  only parsed and planned once; streamed
+                                  queries never are (default: None, i.e.
+                                  never).
+            max_prepared {int} -- number of automatically prepared
+                                  statements kept per connection; the least
+                                  recently used ones are deallocated
+                                  (default: 64).
         """
         super(pgMagics, self).__init__(shell)
-        self.dbconn = None
+        self.conn_name = DEFAULT_CONNECTION
         self.last_query = None
         self.default_host = str(default_host)
         self.default_port = int(default_port)
@@ -106,26 +201,58 @@ class pgMagics(Magics):
         self.auto_commit = bool(auto_commit)
         self.postgis_integration = not bool(disable_postgis_integration)
         self.green_mode = not bool(disable_green_mode)
-        self._geo_types = []
+        self.stream = bool(stream)
+        self.itersize = int(itersize)
+        self.pool_size = int(pool_size)
+        self._conns = {}  # connection used by the magics, by name
+        self._pools = {}  # pool of additional connections, by name
+        self._executor = None  # runs queries in the background
+        self.cache = None  # ResultCache, once enabled with '%pg_cache on'
+        self.history = stats.History()  # timings of recent queries
+        self.plans = {}  # plans from '%pg_explain', by query
+        self._postgis = None  # postgis_integration, once activated
         self._preped_stmts = []
+        self.auto_prepare = None if auto_prepare is None else int(auto_prepare)
+        self.max_prepared = int(max_prepared)
+        self._auto_stmts = {}  # statements to prepare, by connection name
 
     @line_magic
     def pg_connect(self, arg):
         """ Connect to a Postgres database server
 
-        The inline-magic "%pg_connect [DSN]" connects to a Postgres
-        server using psycopg2 and the provided 'DSN'. The connection
-        stays open in the background (managed by this extension), until
-        closed using '%pg_close'.
+        The inline-magic "%pg_connect [--name NAME] [--pool N] [DSN]"
+        connects to a Postgres server using psycopg2 and the provided 'DSN'.
+        The connection stays open in the background (managed by this
+        extension), until closed using '%pg_disconnect'.
+
+        Several connections can be kept open at once under different names
+        ('default' if '--name' is omitted). The last one connected is used
+        by all magics, unless another one is selected with '%pg_use NAME'
+        or, for a single magic, with its '--conn NAME' option. Each named
+        connection comes with a pool of up to N (default: the 'pool_size'
+        passed to the constructor) idle connections to the same database,
+        which background work reuses instead of connecting again.
 
         Example:
            %pg_connect host='localhost' user='root' dbname='postgres'
+           %pg_connect --name warehouse host='dwh' dbname='facts'
         """
 
         if self.green_mode:
-            from . import green_mode
             green_mode.activate()
 
+        options = dict(re.findall(r"--(name|pool)[ =]+(\S+)", arg))
+        arg = re.sub(r"--(name|pool)[ =]+(\S+)", "", arg).strip()
+        name = options.get("name", DEFAULT_CONNECTION)
+        try:
+            pool_size = int(options.get("pool", self.pool_size))
+            if pool_size < 0:
+                raise ValueError()
+        except ValueError:
+            self.shell.write_err("ERROR: invalid pool size '{}'"
+                                 .format(options.get("pool", self.pool_size)))
+            return
+
         try:
             args = re.split(" +", arg)
             args = (re.match(r"^([\w]+) *= *(['\"])?(.*)(?(2)\2|)$", a)
@@ -155,7 +282,7 @@ class pgMagics(Magics):
 
         # quick fiX:
         try:
-            self.dbconn = psycopg2.connect(dsn)
+            conn = psycopg2.connect(dsn)
         except psycopg2.OperationalError as e:
             if "password" in args:
                 self.shell.write_err("ERROR: unable to connect! Got {}"
@@ -169,18 +296,24 @@ class pgMagics(Magics):
             dsn = ("{}='{}'".format(*a) for a in args.items())
             dsn = " ".join(dsn)
             try:
-                self.dbconn = psycopg2.connect(dsn)
+                conn = psycopg2.connect(dsn)
             except psycopg2.OperationalError as e:
                 self.shell.write_err("ERROR: unable to connect! Got {}"
                                      .format(str(e)))
                 return
 
+        self._close(name)
+        self._conns[name] = conn
+        self._pools[name] = ConnectionPool(dsn, maxsize=pool_size,
+                                           connect=self._pooled_connection)
+        self.conn_name = name
         self.shell.write("SUCCESS: connected to {}".format(args["host"]))
+        if name != DEFAULT_CONNECTION:
+            self.shell.write(" as '{}'".format(name))
 
         if self.postgis_integration:
-            try:
-                from . import postgis_integration
-            except ImportError:
+            # shapely itself is only imported once geometries show up
+            if importlib.util.find_spec("shapely") is None:
                 self.shell.write("WARNING: The PostGIS extension has been "
                                  "disabled, because 'shapely' is not "
                                  "installed. You only need this if you work "
@@ -188,44 +321,153 @@ class pgMagics(Magics):
                                  "suppress this error message by "
                                  "disabling the postgis extension.")
             else:
+                from . import postgis_integration
                 try:
-                    postgis_integration.activate(conn=self.dbconn)
+                    # the extension may have been created since the last
+                    # connect, so do not trust the cached lookup
+                    postgis_integration.activate(conn=self.dbconn,
+                                                 refresh=True)
                     self.shell.write("\n  PostGIS integration enabled")
-                    self._geo_types = list(postgis_integration.geo_types())
+                    self._postgis = postgis_integration
                 except postgis_integration.PostGISnotInstalled:
                     pass
 
+    def _pooled_connection(self, dsn):
+        """Open a connection for a pool, with PostGIS casters registered.
+
+        The PostGIS types are known from '%pg_connect' already, so this does
+        not cost any extra round trip.
+        """
+        conn = psycopg2.connect(dsn)
+        if self._postgis is not None:
+            try:
+                self._postgis.activate(conn=conn)
+            except self._postgis.PostGISnotInstalled:
+                pass
+        return conn
+
+    def _geo_type_codes(self, conn):
+        """Type codes of the geometry and geography types of 'conn'."""
+        if self._postgis is None or conn is None:
+            return []
+        return self._postgis.geo_types(conn)
+
     @line_magic
     def pg_disconnect(self, arg):
-        """Close connection to the database server."""
-        if hasattr(self.dbconn, 'close'):
-            self.dbconn.close()
-        self.dbconn = None
+        """Close connection to the database server.
+
+        Usage:
+            %pg_disconnect [NAME]
+
+        Closes the connection NAME (default: the one in use) and its pool.
+        """
+        self._close(str(arg).strip() or self.conn_name)
+
+    def _close(self, name):
+        conn = self._conns.pop(name, None)
+        pool = self._pools.pop(name, None)
+        self._auto_stmts.pop(name, None)
+        if hasattr(conn, 'close'):
+            conn.close()
+        if pool is not None:
+            pool.closeall()
+
+    @line_magic
+    def pg_use(self, arg):
+        """Select the named connection used by the magics.
+
+        Usage:
+            %pg_use [NAME]
+
+        Without NAME, lists the open connections instead.
+        """
+        name = str(arg).strip()
+        if not name:
+            for name in sorted(self._conns):
+                mark = "*" if name == self.conn_name else " "
+                self.shell.write(" {} {}\n".format(mark, name))
+            return
+        self._dbconn(name)
+        self.conn_name = name
+
+    @property
+    def dbconn(self):
+        """Connection in use by the magics (None if not connected)."""
+        return self._conns.get(self.conn_name)
+
+    @property
+    def dsn(self):
+        """DSN of the connection in use (None if not connected)."""
+        pool = self._pools.get(self.conn_name)
+        return None if pool is None else pool.dsn
+
+    def _dbconn(self, name=None):
+        if name is None or name == self.conn_name:
+            if self.dbconn is None:
+                raise RuntimeError("need to connect first (type "
+                                   "'%pg_connect')\n")
+            return self.dbconn
+        if name not in self._conns:
+            raise RuntimeError("no connection named '{0}' (type "
+                               "'%pg_connect --name {0}')\n".format(name))
+        return self._conns[name]
+
+    def pool(self, name=None):
+        """Return the pool of additional connections.
+
+        Arguments:
+            name {str} -- name of the connection (default: the one in use).
 
-    def _dbconn(self):
-        if self.dbconn is None:
-            raise RuntimeError("need to connect first (type '%pg_connect')\n")
-        return self.dbconn
+        Returns:
+            ConnectionPool
+        """
+        self._dbconn(name)
+        return self._pools[self.conn_name if name is None else name]
 
     @line_magic
     def pg_rollback(self, arg):
         """Reset the connection object after an error."""
-        self._dbconn().rollback()
+        self._dbconn(_conn_name(arg)).rollback()
 
     @line_magic
     def pg_commit(self, arg=None):
         """End current transaction by an explicit commit."""
-        self._dbconn().commit()
+        self._dbconn(_conn_name(arg)).commit()
 
     @line_magic
     def pg_cursor(self, arg=None):
-        """Return a new cursor object, for more direct access."""
-        return self._dbconn().cursor()
+        """Return a new cursor object, for more direct access.
+
+        Usage:
+            %pg_cursor [NAME]
+        """
+        return self._dbconn(_conn_name(arg)).cursor()
+
+    def server_cursor(self, itersize=None, conn=None):
+        """Return a new server-side (named) cursor.
+
+        Server-side cursors only transfer rows as they are fetched, 'itersize'
+        rows at a time when iterated over. They only live until the end of the
+        current transaction.
+
+        Arguments:
+            itersize {int} -- rows fetched per round trip (default: the
+                              value passed to the constructor).
+            conn {str} -- name of the connection (default: the one in use).
+        """
+        name = "ipython_pg_{}".format(next(_CURSOR_IDS))
+        cur = self._dbconn(conn).cursor(name=name)
+        cur.itersize = self.itersize if itersize is None else int(itersize)
+        return cur
 
     @line_magic
     def pg_connection(self, arg=None):
-        """Return psycopg2 connection object."""
-        return self._dbconn()
+        """Return psycopg2 connection object.
+
+        Usage:
+            %pg_connection [NAME]
+        """
+        return self._dbconn(_conn_name(arg))
 
     @contextmanager
     def catch_errors(self):
@@ -243,65 +485,321 @@ class pgMagics(Magics):
         elif cur.rowcount == -1:
             self.shell.write("SUCCESS: query did not return any data\n")
             if self.auto_commit:
-                self.pg_commit()
+                cur.connection.commit()
         else:
             self.shell.write("SUCCES: matched {} rows\n".format(cur.rowcount))
 
     def _python_tpl(self, sql):
-        rxp = re.compile(r"(?<!\$)\${([^}:]*)(?::([si]))?}")
-        txt = str(sql)
+        """Evaluate the '${...}' expressions in 'sql' and bind them.
+
+        The template is parsed once per distinct text (see
+        '_compile_template'); each call only evaluates its expressions.
+
+        Returns:
+            tuple -- the statement (psycopg2.sql.Composed) with '%s'
+                     placeholders, and the query arguments.
+        """
+        texts, fields = _compile_template(str(sql))
+        parts = [texts[0]]
         q_args = []
-        f_args = []
 
-        for expr, fmt in rxp.findall(txt):
+        for (expr, fmt), text in zip(fields, texts[1:]):
             ev = self.shell.ev(expr)
-            if fmt:  # if fmt specified, use f-string
-                rep = "{}"
-                if fmt == "s":
-                    ev = psycopg2.sql.Literal(ev)
-                elif fmt == "i":
-                    if hasattr(ev, 'split'):  # split qualified names
-                        ev = ev.split(".")
-                    ev = (psycopg2.sql.Identifier(e) for e in ev)
-                    ev = psycopg2.sql.SQL(".").join(ev)
-                f_args.append(ev)
-            else:  # no fmt, treat as query argument
-                rep = "%s"
+            if fmt == "s":
+                parts.append(psycopg2.sql.Literal(ev))
+            elif fmt == "i":
+                if hasattr(ev, 'split'):  # split qualified names
+                    ev = ev.split(".")
+                ev = (psycopg2.sql.Identifier(e) for e in ev)
+                parts.append(psycopg2.sql.SQL(".").join(ev))
+            else:  # no fmt (or array), treat as query argument
+                if fmt == "a":  # bind any iterable as a single array
+                    ev = ev.tolist() if hasattr(ev, 'tolist') else list(ev)
+                parts.append(_PLACEHOLDER)
                 q_args.append(ev)
-            expr = ":".join([expr, fmt]) if fmt else expr
-            txt = txt.replace("${%s}" % expr, rep)
+            parts.append(text)
 
-        txt = psycopg2.sql.SQL(txt).format(*f_args)
-        return txt, q_args
+        return psycopg2.sql.Composed(parts), q_args
 
-    def query(self, sql, silent=False, propagate=False):
-        """Query the database and perform variable substitution.
+    def _render(self, sql, dbconn):
+        """Return 'sql' as string (or SQL) and the query arguments.
 
-        Arguments:
-            sql {str or SQL} -- SQL command to execute.
-            silent {bool} -- if True, only print error messages.
-            propagate {bool} -- if True, reraise database errors.
+        Expressions in '${...}' are evaluated in the user's namespace.
         """
         args = []
-        sql = (sql.as_string(self.dbconn) if hasattr(sql, 'as_string')
+        sql = (sql.as_string(dbconn) if hasattr(sql, 'as_string')
                else str(sql))
+        if self._postgis is not None:
+            self._postgis.register_shapely2postgis_if_imported()
         if "${" in sql:
             sql, args = self._python_tpl(sql)
+        return sql, args
+
+    @staticmethod
+    def _is_query(sql, dbconn):
+        """True if 'sql' is a statement that returns rows."""
+        sql = (sql.as_string(dbconn) if hasattr(sql, 'as_string')
+               else str(sql))
+        return RXP_QUERY.match(sql) is not None
+
+    def _cache_key(self, kind, sql, args, dbconn, stream=None,
+                   itersize=None):
+        """Key of the cached result of a rendered query (None if uncached).
+
+        Only queries that return rows and are not streamed are cached.
+        """
+        if self.cache is None:
+            return None
+        if stream is None:
+            stream = self.stream or itersize is not None
+        if stream or not self._is_query(sql, dbconn):
+            return None
+        with dbconn.cursor() as cur:
+            rendered = cur.mogrify(sql, args)
+        return ResultCache.key(kind, rendered, dbconn.dsn)
+
+    def _invalidate(self, cur):
+        """Clear the result cache after statements that return no rows.
+
+        Server-side cursors (only used for queries) have no description
+        until their first fetch, so they never clear it.
+        """
+        if (self.cache is not None and cur.name is None
+                and cur.description is None):
+            self.cache.clear()
+
+    def cached_query(self, sql, conn=None, **options):
+        """Like 'query', but serve the rows from the result cache.
+
+        If the cache is enabled (see '%pg_cache'), the rows of queries are
+        fetched at once and kept in the cache; the cursor returned is then
+        a read-only 'CachedCursor' over them.
+        """
+        dbconn = self._dbconn(conn)
+        sql, args = self._render(sql, dbconn)
+        key = self._cache_key("rows", sql, args, dbconn,
+                              options.get("stream"), options.get("itersize"))
+        hit = None if key is None else self.cache.get(key)
+        if hit is not None:
+            rows, description = hit
+            self.shell.write("SUCCESS: {} rows from cache\n"
+                             .format(len(rows)))
+            return CachedCursor(rows, description)
+
+        cur = self.query(sql, conn=conn, args=args, **options)
+        if key is None or cur.description is None:
+            return cur
+        rows = cur.fetchall()
+        self.cache.put(key, rows, cur.description)
+        return CachedCursor(rows, cur.description)
+
+    def query(self, sql, silent=False, propagate=False, stream=None,
+              itersize=None, conn=None, args=None, raw_geometries=False):
+        """Query the database and perform variable substitution.
 
+        Arguments:
+            sql {str or SQL} -- SQL command to execute.
+            silent {bool} -- if True, only print error messages.
+            propagate {bool} -- if True, reraise database errors.
+            stream {bool} -- if True, fetch results through a server-side
+                             cursor; statements that do not return rows
+                             always use an ordinary cursor (default: the
+                             value passed to the constructor).
+            itersize {int} -- rows per batch when streaming; implies
+                              'stream' unless it is explicitly False.
+            conn {str} -- name of the connection to use (default: the one
+                          in use).
+            args {sequence} -- query arguments; if given, 'sql' is taken
+                               as rendered already (see '_render').
+            raw_geometries {bool} -- if True, fetch geometries as hex-wkb,
+                                     to be decoded by '_decorate_dataframe'
+                                     (default: False).
+
+        Statements that do not return rows clear the result cache.
+        """
+        dbconn = self._dbconn(conn)
+        if stream is None:
+            stream = self.stream or itersize is not None
+        stream = stream and self._is_query(sql, dbconn)
+        if args is None:
+            sql, args = self._render(sql, dbconn)
+        if isinstance(sql, str) and RXP_DEALLOCATE.match(sql):
+            self._auto_stmts.pop(self.conn_name if conn is None else conn,
+                                 None)
+
+        prepared = None
         try:
-            cur = self.pg_cursor()
-            cur.execute(sql, args)
-            if not silent:
+            if stream:
+                cur = self.server_cursor(itersize, conn=conn)
+            else:
+                cur = dbconn.cursor()
+                sql, args, prepared = self._auto_prepared(sql, args, dbconn,
+                                                          conn)
+            if raw_geometries:
+                self._raw_geometries(cur)
+            with stats.phase("execute"), green_mode.cancellable(dbconn):
+                cur.execute(sql, args)
+            if cur.rowcount >= 0:
+                stats.count(rows=cur.rowcount)
+            self._invalidate(cur)
+            if stream and not silent:
+                self.shell.write("SUCCESS: streaming results in batches of "
+                                 "{} rows\n".format(cur.itersize))
+            elif not silent:
                 self.cur_report(cur)
         except psycopg2.Error as e:
             self.shell.write_err("ERROR: {}\n".format(str(e)))
-            self.dbconn.rollback()
+            stats.fail()
+            dbconn.rollback()
+            if prepared is not None:
+                # e.g. deallocated by the user, or its result type changed
+                entry = self._auto_stmts.get(prepared[0], {}).pop(
+                    prepared[1], None)
+                if isinstance(entry, str):
+                    _deallocate(dbconn, entry)
             if propagate:
                 raise e
         return cur
 
+    def _auto_prepared(self, sql, args, dbconn, conn=None):
+        """Count the executions of a rendered statement, preparing it once
+        they reach 'auto_prepare'.
+
+        Statements are told apart by their text with placeholders, i.e.
+        before the arguments are filled in, and by the types of their
+        arguments: the parameters are declared with the types the literals
+        of the arguments would have, so that results do not change once a
+        statement is prepared. Statements with arguments of other types are
+        not prepared.
+
+        Returns:
+            tuple -- the statement to execute ('EXECUTE' of the prepared
+                     statement, if there is one), its arguments, and the
+                     key of the prepared statement (or None).
+        """
+        if not self.auto_prepare or not args:
+            return sql, args, None
+        text = (sql.as_string(dbconn) if hasattr(sql, 'as_string')
+                else str(sql)).strip().rstrip(";")
+        if RXP_PREPARABLE.match(text) is None or ";" in text:
+            return sql, args, None  # PREPARE only takes single statements
+        types = tuple(_parameter_type(arg) for arg in args)
+        if None in types:
+            return sql, args, None
+
+        name = self.conn_name if conn is None else conn
+        stmts = self._auto_stmts.setdefault(name, OrderedDict())
+        key = (text, types)
+        entry = stmts.pop(key, 0)  # count of executions, or statement name
+        if isinstance(entry, int):
+            entry += 1
+            if entry >= self.auto_prepare:
+                entry = _prepare(dbconn, text, types)
+        stmts[key] = entry
+        self._deallocate_unused(stmts, dbconn)
+
+        if not isinstance(entry, str):
+            return sql, args, None
+        placeholders = ", ".join(["%s"] * len(args))
+        sql = "execute {} ({})".format(entry, placeholders)
+        return sql, args, (name, key)
+
+    def _deallocate_unused(self, stmts, dbconn):
+        """Deallocate the least recently used of the prepared 'stmts'."""
+        names = [k for k, v in stmts.items() if isinstance(v, str)]
+        for key in names[:max(len(names) - self.max_prepared, 0)]:
+            with dbconn.cursor() as cur:
+                cur.execute("deallocate {}".format(stmts.pop(key)))
+        # forget about statements that have not been run in a long time
+        counted = [k for k, v in stmts.items() if not isinstance(v, str)]
+        for key in counted[:max(len(counted) - 10 * self.max_prepared, 0)]:
+            del stmts[key]
+
+    def query_async(self, sql, output=None, conn=None, convert=None,
+                    copy=False):
+        """Run a query in the background and return at once.
+
+        The query runs in a worker thread, on a connection checked out of the
+        pool of the named connection, and in a transaction of its own that is
+        committed if it succeeds. Template expressions ('${...}') are
+        evaluated right away. Results are never cached.
+
+        Arguments:
+            sql {str or SQL} -- SQL command to execute.
+            output {str} -- if given, name of the variable the result is
+                            stored under once it is available.
+            conn {str} -- name of the connection whose pool to use
+                          (default: the one in use).
+            convert {callable} -- called with the cursor (and its
+                                  description) in the worker thread, which
+                                  fetches geometries as hex-wkb (see
+                                  '_raw_geometries'); its return value is
+                                  the result (default: a cursor over the
+                                  rows fetched).
+            copy {bool} -- if True, fetch the rows with COPY TO STDOUT into
+                           a DataFrame, passed to 'convert' instead of the
+                           cursor (default: False).
+
+        Returns:
+            concurrent.futures.Future -- resolves to the result.
+        """
+        pool = self.pool(conn)
+        sql, args = self._render(sql, self._dbconn(conn))
+
+        def run():
+            from . import dataframes
+
+            # Ctrl-C only cancels statements in the foreground
+            with green_mode.detached(), \
+                    stats.record(self.history, "query_async", sql), \
+                    pool.connection() as bgconn:
+                cur = bgconn.cursor()
+                if copy or convert is not None:
+                    self._raw_geometries(cur)  # before executing
+                if copy:
+                    result, description = dataframes.copy_to_dataframe(
+                        cur, sql, args)
+                else:
+                    with stats.phase("execute"):
+                        cur.execute(sql, args)
+                    self._invalidate(cur)
+                    result, description = cur, cur.description
+                    if convert is None and description is not None:
+                        # the connection is back in the pool, or even
+                        # closed, by the time the result is used
+                        with stats.phase("fetch"):
+                            result = CachedCursor(cur.fetchall(),
+                                                  description)
+                if convert is not None:
+                    result = convert(result, description)
+                bgconn.commit()
+            return result
+
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.pool_size,
+                thread_name_prefix="ipython_pg")
+        future = self._executor.submit(run)
+        future.add_done_callback(lambda f: self._async_done(f, output))
+        return future
+
+    def _async_done(self, future, output=None):
+        """Report the outcome of a background query, store its result."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.shell.write_err("ERROR: background query failed: {}\n"
+                                 .format(str(error)))
+        elif output:
+            self.shell.push({output: future.result()})
+            self.shell.write("SUCCESS: background query stored under '{}'\n"
+                             .format(output))
+
 
     @line_cell_magic
+    @_recorded
     def pg_sql(self, line, cell=None):
         """Query the database.
 
@@ -312,7 +810,8 @@ class pgMagics(Magics):
            [<varname> = ]%pg_sql <sql>
 
         Usage as cell magic:
-           %%pg_sql [<varname>]
+           %%pg_sql [<varname>] [--stream] [--itersize N] [--conn NAME]
+                    [--async] [--profile]
            <sql>
 
         When used as a line-magic, the cursor used to query the database is
@@ -320,9 +819,12 @@ class pgMagics(Magics):
         to the default output (in which case it is accessible thorugh _*).
 
         As a cell-magic, when used without the optional <varname> argument,
-        results are returned as an HTML table in a IPthon.display.HTML
-        instance. Note that, in order not to destabilize the browser, only the
-        first 500 rows are displayed. If however <varname> is specified, then
+        results are returned as an HTML table by a display.ResultPager. Note
+        that, in order not to destabilize the browser, only 500 rows are
+        displayed at a time; '_.next()' and '_.prev()' move between pages,
+        '_.widget()' returns a version with buttons (requires ipywidgets).
+        Pages are fetched when first shown, so with '--stream' the rows
+        are only transferred when paged to. If <varname> is specified, then
         no output is provided, but instead the cursor that queried the database
         is made available as a local variable of name <varname>.
 
@@ -336,9 +838,49 @@ class pgMagics(Magics):
         is equivalent to:
 
             In [3]: %pg_sql select * from tbl where id = 2
+
+        Values are passed as query arguments. With '${<expr>:s}' they are
+        inlined as literals instead, with '${<expr>:i}' as identifiers (e.g.
+        table names), and with '${<expr>:a}' any sequence (e.g. a numpy
+        array) is passed as a single array argument:
+
+            In [4]: %pg_sql select * from tbl where id = any(${ids:a})
+
+        With '--stream', the rows are fetched through a server-side cursor,
+        in batches of N rows if '--itersize' is given (which implies
+        '--stream'). '--conn' runs the query on the named connection NAME.
+
+        With '--async', the query runs in the background (see
+        'query_async') and a concurrent.futures.Future is returned right
+        away. The cursor is stored under <varname> once the query is done.
+
+        If the result cache is enabled (see '%pg_cache'), repeated queries
+        are answered from the cache by a read-only cursor. '--profile'
+        prints the time spent in each phase (see '%pg_stats').
         """
-        query, output = _line_cell_prep(line, cell)
-        cur = self.query(query)
+        query, args = _line_cell_prep(line, cell)
+        args = args if args else ""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('output', type=str, nargs='?')
+        _add_stream_arguments(parser)
+        _add_conn_argument(parser)
+        _add_async_argument(parser)
+        _add_profile_argument(parser)
+        try:
+            ns = parser.parse_args(args.strip().split(" "))
+        except SystemExit:
+            return
+
+        _profile(ns)
+        output = ns.output
+        if ns.background:
+            if ns.stream or ns.itersize is not None:
+                self.shell.write_err("ERROR: '--async' cannot be combined "
+                                     "with '--stream'\n")
+                return
+            return self.query_async(query, output=output, conn=ns.conn)
+
+        cur = self.cached_query(query, conn=ns.conn, **_stream_options(ns))
 
         if output:
             self.shell.write(" cursor object as '{}'\n".format(output))
@@ -351,6 +893,7 @@ class pgMagics(Magics):
         return self.display_cur_as_table(cur)
 
     @line_cell_magic
+    @_recorded
     def pg_pd(self, line, cell=None):
         """Query the database.
 
@@ -361,7 +904,9 @@ class pgMagics(Magics):
         instead, with is geometry set to the first geo-spatial column.
 
         Usage:
-            %%pg_pd [output] [--idx [IDX] [IDX] ...]
+            %%pg_pd [output] [--idx [IDX] [IDX] ...] [--stream] [--itersize N]
+                    [--copy] [--chunksize M] [--conn NAME] [--async]
+                    [--profile]
             [query]
 
         Arguments:
@@ -371,7 +916,24 @@ class pgMagics(Magics):
                     space separated list to create a multi-index. If '--idx' is
                     used without specifying [IDX], the first column will be
                     used by default.
+            [N] - fetch rows through a server-side cursor, N at a time
+                  ('--stream' alone uses the default batch size).
+            --copy - transfer the results using 'COPY (query) TO STDOUT',
+                     which is much faster for large results. Only works
+                     for statements that return rows.
+            [M] - return a generator of DataFrames of M rows each instead
+                  of one DataFrame, fetched through a server-side cursor as
+                  the generator is iterated over (see 'iter_frames').
+            [NAME] - named connection to use (see '%pg_connect').
+            --async - run the query in the background and return a
+                      concurrent.futures.Future; the DataFrame is stored
+                      as [output] once it is available.
+            --profile - print the time spent in each phase (see
+                        '%pg_stats').
             [query] - SQL query to execute.
+
+        If the result cache is enabled (see '%pg_cache'), repeated queries
+        are answered from the cache.
         """
         query, args = _line_cell_prep(line, cell)
         args = args if args else ""
@@ -379,13 +941,74 @@ class pgMagics(Magics):
         parser.add_argument('output', type=str, nargs='?')
         parser.add_argument('--idx', type=str, nargs="+")
         parser.add_argument('--gpd')
+        parser.add_argument('--copy', action='store_true')
+        parser.add_argument('--chunksize', type=int)
+        _add_stream_arguments(parser)
+        _add_conn_argument(parser)
+        _add_async_argument(parser)
+        _add_profile_argument(parser)
         try:
             ns = parser.parse_args(args.strip().split(" "))
         except SystemExit:
             return
 
-        cur = self.query(query)
-        dta = self._as_pandas_dataframe(cur, index=ns.idx)
+        from . import dataframes
+
+        _profile(ns)
+        if ns.chunksize is not None and (ns.copy or ns.background):
+            self.shell.write_err("ERROR: '--chunksize' cannot be combined "
+                                 "with '--copy' or '--async'\n")
+            return
+        if ns.background:
+            if ns.stream or ns.itersize is not None:
+                self.shell.write_err("ERROR: '--async' cannot be combined "
+                                     "with '--stream'\n")
+                return
+            dbconn = self._dbconn(ns.conn)
+
+            def convert(result, description):
+                if not ns.copy:
+                    result = dataframes.cursor_to_dataframe(result)
+                return self._decorate_dataframe(result, description,
+                                                index=ns.idx, conn=dbconn)
+            return self.query_async(query, output=ns.output, conn=ns.conn,
+                                    convert=convert, copy=ns.copy)
+
+        dbconn = self._dbconn(ns.conn)
+        sql, sql_args = self._render(query, dbconn)
+        if ns.chunksize is not None:
+            try:
+                frames = self.iter_frames(sql, chunksize=ns.chunksize,
+                                          conn=ns.conn, index=ns.idx,
+                                          args=sql_args)
+            except psycopg2.Error:
+                return  # reported by 'query' already
+            if ns.output:
+                self.shell.write(" DataFrames of {} rows stored as generator "
+                                 "'{}'\n".format(ns.chunksize, ns.output))
+                self.shell.push({ns.output: frames})
+                return
+            return frames
+        key = self._cache_key("frame", sql, sql_args, dbconn,
+                              **_stream_options(ns))
+        hit = None if key is None else self.cache.get(key)
+        if hit is not None:
+            dta, description = hit
+            self.shell.write("SUCCESS: {} rows from cache\n"
+                             .format(len(dta)))
+        elif ns.copy:
+            dta, description = self._copy_to_dataframe(sql, sql_args,
+                                                        conn=ns.conn)
+        else:
+            cur = self.query(sql, conn=ns.conn, args=sql_args,
+                             raw_geometries=True, **_stream_options(ns))
+            dta = dataframes.cursor_to_dataframe(cur)
+            description = cur.description
+
+        if hit is None and key is not None and description is not None:
+            self.cache.put(key, dta, description)
+        dta = self._decorate_dataframe(dta, description, index=ns.idx,
+                                       conn=dbconn)
 
         if ns.output:
             self.shell.write(" results stored as '{}'\n".format(ns.output))
@@ -394,16 +1017,116 @@ class pgMagics(Magics):
 
         return dta
 
+    def iter_frames(self, sql, chunksize=None, conn=None, index=None,
+                    args=None):
+        """Run a query and return its results as a generator of DataFrames.
+
+        The query runs right away; its rows are then fetched through a
+        server-side cursor, 'chunksize' rows per DataFrame, as the generator
+        is iterated over. All chunks have the same columns and dtypes (see
+        'dataframes.iter_dataframes'), and only one is held at a time. The
+        cursor lives until the end of the transaction, so the generator has
+        to be used up before the connection commits or rolls back.
+
+        Arguments:
+            sql {str or SQL} -- query to run ('${...}' expressions are
+                                substituted, see '%pg_sql').
+            chunksize {int} -- rows per DataFrame (default: the 'itersize'
+                               passed to the constructor).
+            conn {str} -- name of the connection to use (default: the one
+                          in use).
+            index {list} -- columns to use as index of each chunk (default:
+                            None).
+            args {sequence} -- query arguments; if given, 'sql' is taken
+                               as rendered already.
+
+        Returns:
+            generator -- of pandas.DataFrame (or GeoDataFrame)
+        """
+        dbconn = self._dbconn(conn)
+        cur = self.query(sql, conn=conn, args=args, stream=True,
+                         itersize=chunksize, propagate=True,
+                         raw_geometries=True)
+        return self._frames(cur, index, dbconn)
+
+    def _frames(self, cur, index, dbconn):
+        from . import dataframes
+
+        for dta in dataframes.iter_dataframes(cur):
+            yield self._decorate_dataframe(dta, cur.description, index=index,
+                                           conn=dbconn)
+
     def _as_pandas_dataframe(self, cur, index=None):
+        """Convert the results of 'cur', which fetches geometries as hex-wkb
+        (see '_raw_geometries'), to a DataFrame."""
+        import pandas as pd
+        from . import dataframes
+
         if not cur:
             return pd.DataFrame([])
-        dta = pd.DataFrame([r for r in cur],
-                           columns=[c.name for c in cur.description])
-        geocols = [c.name for c in cur.description
-                   if c.type_code in self._geo_types]
+        dta = dataframes.cursor_to_dataframe(cur)
+        return self._decorate_dataframe(dta, cur.description, index=index,
+                                        conn=cur.connection)
+
+    def _copy_to_dataframe(self, sql, args, conn=None):
+        """Run rendered 'sql' through COPY TO STDOUT.
+
+        Returns:
+            tuple -- the DataFrame and the description of its columns.
+        """
+        from . import dataframes
+
+        dbconn = self._dbconn(conn)
+        try:
+            with dbconn.cursor() as cur:
+                self._raw_geometries(cur)
+                dta, description = dataframes.copy_to_dataframe(cur, sql,
+                                                                args)
+        except psycopg2.Error as e:
+            dbconn.rollback()
+            raise e
+
+        self.shell.write("SUCCES: copied {} rows\n".format(len(dta)))
+        return dta, description
+
+    def _decorate_dataframe(self, dta, description, index=None, conn=None):
+        """Set the index and turn results with geometries into GeoPandas.
+
+        Arguments:
+            conn {connection} -- connection that ran the query, to tell
+                                 which types are geometries (default: the
+                                 connection in use).
+        """
+        conn = self.dbconn if conn is None else conn
+        with stats.phase("decorate"):
+            return self._set_index_and_geometry(dta, description, index,
+                                                self._geo_type_codes(conn))
+
+    def _raw_geometries(self, cur):
+        """Fetch geometries as hex-wkb with 'cur', to decode them in bulk.
+
+        Must be called before the statement is executed: client-side
+        cursors pick their typecasters then. Geometries are decoded by
+        '_decorate_dataframe' then.
+        """
+        geo_types = self._geo_type_codes(cur.connection)
+        if geo_types:
+            self._postgis.register_hexwkb_passthrough(geo_types, cur)
+
+    def _set_index_and_geometry(self, dta, description, index, geo_types):
+        geocols = [c.name for c in description or ()
+                   if c.type_code in geo_types]
+
+        if geocols:
+            dta = dta.copy(deep=False)  # leave cached results alone
+            with stats.phase("geometry"):
+                for i, col in enumerate(description):
+                    if col.type_code in geo_types:
+                        dta.isetitem(i, self._postgis.cast_hexwkb_array(
+                            dta.iloc[:, i].to_numpy(dtype=object)))
 
         if index:
-            dta.set_index(index, inplace=True)
+            dta = dta.set_index(index)
 
         if not geocols:
             return dta
@@ -462,6 +1185,7 @@ class pgMagics(Magics):
         return row
 
     @line_cell_magic
+    @_recorded
     def pg_tuple(self, line, cell=None):
         """Return each column as a tuple.
 
@@ -469,24 +1193,42 @@ class pgMagics(Magics):
             [<var1>[, <var2>]... = ] %pg_tuple <sql>
 
         Cell magic usage:
-            %%pg_tuple [<var1>[, <var2>]...]
+            %%pg_tuple [<var1>[, <var2>]...] [--stream] [--itersize N]
+                       [--conn NAME] [--profile]
             <sql>
 
         This magic returns a tuple of tuples, where each tuple corresponds
         to the data of a column of the result table. If just one output
         variable ("<var1>") is specified, the tuple of tuples will be availabe
         there. If multiple <var> are specified (as many as there are columns),
-        the tuple of tuple will be expanded onto them.
+        the tuple of tuple will be expanded onto them. '--stream' and
+        '--itersize' fetch the rows through a server-side cursor, '--conn'
+        runs the query on the named connection NAME, and '--profile' prints
+        the time spent in each phase (see '%pg_stats').
         """
         query, args = _line_cell_prep(line, cell)
-        args = re.split(", *", args) if args else []
-        cur = self.query(query)
+        args = args if args else ""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('output', type=str, nargs='*')
+        _add_stream_arguments(parser)
+        _add_conn_argument(parser)
+        _add_profile_argument(parser)
+        try:
+            ns = parser.parse_args(args.strip().split(" "))
+        except SystemExit:
+            return
+
+        _profile(ns)
+        args = [a for a in re.split("[, ]+", " ".join(ns.output)) if a]
+        cur = self.query(query, conn=ns.conn, **_stream_options(ns))
+        with stats.phase("fetch"):
+            columns = tuple(zip(*cur))
 
         if not args:
-            return tuple(zip(*cur))
+            return columns
 
         if len(args) == 1:
-            self.shell.push({args[0]: tuple(zip(*cur))})
+            self.shell.push({args[0]: columns})
             self.shell.write(" result stored under '{}'\n".format(args[0]))
             return
 
@@ -497,54 +1239,159 @@ class pgMagics(Magics):
             raise ValueError("too few values to unpack (expected {})"
                              .format(len(args)))
 
-        for arg, values in zip(args, zip(*cur)):
+        for arg, values in zip(args, columns):
             self.shell.push({arg: tuple(values)})
         output = ", ".join("'{}'".format(s) for s in args)
         self.shell.write(" results stored under \n".format(output))
 
+    @line_cell_magic
+    def pg_explain(self, line, cell=None):
+        """Run a query with EXPLAIN ANALYZE and return its plan.
+
+        Line magic usage:
+            %pg_explain <sql>
+
+        Cell magic usage:
+            %%pg_explain [<varname>] [--no-analyze] [--name NAME] [--diff]
+                         [--conn NAME]
+            <sql>
+
+        Arguments:
+            <varname> - name of the variable to store the plan under.
+            --no-analyze - only plan the query, without running it.
+            [NAME] - name to keep the plan under in the history (default:
+                     the query itself).
+            --diff - compare the plan node by node with the previous one of
+                     the same name, e.g. before and after creating an index,
+                     and return the differences instead.
+
+        The query runs with 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)' and is
+        always rolled back, so statements that modify data can be explained
+        safely. Template expressions ('${...}') work as in '%pg_sql'. The
+        plan's 'nodes' DataFrame holds one row per node with its timings,
+        row estimate error ('rows_error', actual over estimated rows) and
+        buffer usage; nodes taking much of the execution time by themselves
+        are flagged as 'hot'. Past plans are listed by '%pg_plans'.
+        """
+        query, args = _line_cell_prep(line, cell)
+        args = args if args else ""
+        parser = argparse.ArgumentParser()
+        parser.add_argument('output', type=str, nargs='?')
+        parser.add_argument('--no-analyze', dest='analyze',
+                            action='store_false')
+        parser.add_argument('--name', type=str)
+        parser.add_argument('--diff', action='store_true')
+        _add_conn_argument(parser)
+        try:
+            ns = parser.parse_args(args.strip().split(" "))
+        except SystemExit:
+            return
+
+        from . import explain
+
+        options = ("ANALYZE, BUFFERS, FORMAT JSON" if ns.analyze
+                   else "FORMAT JSON")
+        sql = "EXPLAIN ({}) {}".format(options, str(query).strip())
+        dbconn = self._dbconn(ns.conn)
+        sql, sql_args = self._render(sql, dbconn)
+        try:
+            # not through 'query', whose rollback on errors would undo
+            # earlier statements of the transaction as well
+            with self._rolled_back(dbconn), dbconn.cursor() as cur:
+                with green_mode.cancellable(dbconn):
+                    cur.execute(sql, sql_args)
+                plan = explain.Plan(cur.fetchone()[0], sql=query)
+        except psycopg2.Error as e:
+            self.shell.write_err("ERROR: {}\n".format(str(e)))
+            return
+
+        name = ns.name or " ".join(str(query).split())
+        history = self.plans.setdefault(name, [])
+        history.append(plan)
+        self.shell.write("SUCCESS: {}\n".format(plan.summary()))
+
+        result = plan
+        if ns.diff:
+            if len(history) < 2:
+                self.shell.write_err("WARNING: no previous plan to compare "
+                                     "with\n")
+            else:
+                result = explain.diff(history[-2], plan)
+
+        if ns.output:
+            self.shell.write(" plan stored as '{}'\n".format(ns.output))
+            self.shell.push({ns.output: result})
+            return
+        return result
+
+    @line_magic
+    def pg_plans(self, line):
+        """List the plans kept by '%pg_explain'.
+
+        Usage:
+            %pg_plans [NAME]
+
+        Without NAME, returns a DataFrame with one row per plan; with NAME,
+        the list of plans of that name, oldest first.
+        """
+        import pandas as pd
+
+        name = line.strip()
+        if name:
+            return list(self.plans.get(name, []))
+
+        rows = []
+        for name, history in self.plans.items():
+            for i, plan in enumerate(history):
+                top = plan.hottest(1)
+                rows.append((name, i, plan.created, plan.planning_ms,
+                             plan.execution_ms,
+                             top["node"].iloc[0] if len(top) else None))
+        return pd.DataFrame(rows, columns=["name", "run", "created",
+                                           "planning_ms", "execution_ms",
+                                           "hottest"])
+
+    @contextmanager
+    def _rolled_back(self, dbconn):
+        """Undo the enclosed statements, but not earlier ones, also if
+        they fail."""
+        with dbconn.cursor() as cur:
+            if dbconn.autocommit:
+                cur.execute("BEGIN")
+                undo = "ROLLBACK"
+            else:
+                cur.execute("SAVEPOINT ipython_pg_explain")
+                undo = ("ROLLBACK TO SAVEPOINT ipython_pg_explain; "
+                        "RELEASE SAVEPOINT ipython_pg_explain")
+        try:
+            yield
+        finally:
+            with dbconn.cursor() as cur:
+                cur.execute(undo)
+
     def display_cur_as_table(self, cur, row_limit=500):
         """Display the results in the given cursor object as HTML table.
 
+        Rows are shown one page at a time (see 'display.ResultPager'); each
+        page is fetched from the cursor when it is first shown, so the rows
+        of server-side cursors ('--stream') are only transferred when paged
+        to.
+
         Arguments:
             cur {cursor} -- results to be displayed
-            row_limit {int} -- number of rows to display (default: 500)
+            row_limit {int} -- number of rows per page (default: 500)
 
         Returns:
-            IPython.display.HTML -- HTML table representation
+            display.ResultPager -- pager showing the first page
         """
-        if cur.rowcount < 1:
+        if cur.name is None and (cur.rowcount < 1 or cur.description is None):
             return  # no results to display
 
-        html = ['<table width="100%">']
-
-        html.append("<thead>")
-        html.append("<tr>")
-        for col in cur.description:
-            html.append("<th>{}</th>".format(col[0]))
-        html.append("</tr>")
-        html.append("</thead>")
-
-        html.append("<tbody>")
-
-        if not hasattr(cur, 'description') or cur.rowcount == 0:
-            html.append('<tr>')
-            html.append('<td colspan="{}" align="center">'
-                        .format(len(cur.description)))
-            html.append('(no results to display)')
-            html.append('</td></tr>')
-
-        for i, row in enumerate(cur):
-            if i >= row_limit:
-                self.shell.write("WARNING: displaying only the first {} rows"
-                                 .format(row_limit))
-                break
-            html.append("<tr>")
-            for cell in row:
-                html.append("<td>{}</td>".format(str(cell)))
-            html.append("</tr>")
-        html.append("</tbody>")
-        html.append("</table>")
-        return HTML("".join(html))
+        pager = display.ResultPager(cur, page_size=row_limit)
+        if not pager.rows():
+            return
+        pager._repr_html_()  # render the first page within the record
+        return pager
 
     @line_magic
     def pg_info(self, obj):
@@ -574,57 +1421,319 @@ class pgMagics(Magics):
         return self.display_cur_as_table(cur)
 
     @line_magic
-    def pg_copy(self, line):
+    @_recorded
+    def pg_copy(self, line, cell=None):
         """Quickly copy data to postgres using native COPY.
 
         Postgres' `COPY` is intended to move large chunks from and to a
-        database. The `on conflict` system of `insert` does not work, i.e. if
-        duplicate will beinserted despite primary keys or unique indices).
-        So be careful here as this could mess up your table.
+        database. The `on conflict` system of `insert` does not work with it,
+        i.e. rows violating primary keys or unique indices make the whole
+        copy fail. With '--on-conflict', the data is copied into a temporary
+        staging table first, and from there inserted into the target with a
+        single `INSERT ... ON CONFLICT`, so that reloading the same data
+        updates (or skips) the rows already there.
 
         Usage:
-            %pg_copy [source] [target]
+            %pg_copy [source] [target] [--format csv|binary] [--chunksize N]
+                     [--jobs J [--staging]] [--on-conflict update|ignore
+                     [--key COLS]] [--conn NAME] [--profile]
 
         Arguments:
             [source] - any Python expression evaluating to a DataFrame
             [target] - name of the target table (DO NOT quotes names!)
+            --format - 'binary' encodes the data in postgres' binary COPY
+                       format, which is faster for numeric and timestamp
+                       data; the default is 'csv'.
+            [N] - number of rows serialised at once (default: 10000); the
+                  data is sent in a single COPY while it is serialised.
+            --jobs [J] - split the data into J parts, copied in parallel
+                         over J additional connections (default: 1).
+            --staging - with '--jobs', copy the parts into staging tables
+                        first, and from there into the target in a single
+                        transaction; if anything fails, the target is left
+                        untouched.
+            --on-conflict - 'update' to overwrite the existing rows with
+                            the same key (of rows with the same key in the
+                            data, the last one wins), or 'ignore' to keep
+                            them; implies '--staging' with '--jobs'.
+            [COLS] - comma-separated columns of the unique index or primary
+                     key that decides about conflicts (default: the
+                     primary key of the target).
+            [NAME] - named connection to use (see '%pg_connect').
+            --profile - print the time spent in each phase (see
+                        '%pg_stats').
         """
         parser = argparse.ArgumentParser()
         parser.add_argument('source', type=str,
                             help="Python expression evaluating to a DataFrame")
         parser.add_argument('target', type=str, help="Target table")
-        parser.add_argument('--chunksize', type=int,
-                            help=("number of lines to copy at once (their "
-                                  "CSV representation needs to fit in memory"))
+        parser.add_argument('--chunksize', type=int, default=10000,
+                            help=("number of rows to serialise at once (a "
+                                  "few serialised chunks are held in "
+                                  "memory)"))
+        parser.add_argument('--format', choices=("csv", "binary"),
+                            default="csv", help="data format used by COPY")
+        parser.add_argument('--jobs', type=int, default=1,
+                            help="number of connections to copy over")
+        parser.add_argument('--staging', action='store_true',
+                            help=("with --jobs, copy into staging tables "
+                                  "first, then into the target at once"))
+        parser.add_argument('--on-conflict', choices=("update", "ignore"),
+                            dest='on_conflict',
+                            help=("what to do with rows that already exist "
+                                  "in the target"))
+        parser.add_argument('--key', type=str,
+                            help=("comma-separated columns deciding about "
+                                  "conflicts (default: the primary key)"))
+        _add_conn_argument(parser)
+        _add_profile_argument(parser)
         try:
             ns = parser.parse_args(line.strip().split(" "))
         except SystemExit:
             return
 
+        _profile(ns)
         dta = self.shell.ev(ns.source)
         if not hasattr(dta, 'to_csv'):
             raise NotImplementedError("currently only works with DataFrames")
+        import pandas as pd
         if isinstance(dta.index, pd.MultiIndex):
             raise ValueError('cannot `%pg_copy` a DataFrame with a MultiIndex. '
                              'Use `reset_index` to flatten the index.')
 
-        from . import green_mode
-        _reactivate = self.green_mode
-        if _reactivate:
-            self.shell.write("  waring: green-mode temporarily deactivated ("
-                             "interrupt won't abort the import)")
-            green_mode.deactivate()
+        key = None if ns.key is None else [k.strip()
+                                           for k in ns.key.split(",")]
+        dbconn = self._dbconn(ns.conn)
+        if ns.jobs > 1:
+            # the workers register their connections to be cancelled
+            with green_mode.cancellable(None):
+                parallel_copy_pandas_dataframe(self.pool(ns.conn), dta,
+                                               ns.target, jobs=ns.jobs,
+                                               staging=ns.staging,
+                                               on_conflict=ns.on_conflict,
+                                               key=key,
+                                               chunk=ns.chunksize,
+                                               format=ns.format)
+            if self.cache is not None:
+                self.cache.clear()
+            return
+
         try:
-            with self.pg_cursor() as cur:
-                copy_pandas_dataframe(cur, dta, ns.target)
-            self.dbconn.commit()
+            with dbconn.cursor() as cur:
+                if ns.on_conflict:
+                    upsert_pandas_dataframe(cur, dta, ns.target, key=key,
+                                            on_conflict=ns.on_conflict,
+                                            chunk=ns.chunksize,
+                                            format=ns.format)
+                else:
+                    copy_pandas_dataframe(cur, dta, ns.target,
+                                          chunk=ns.chunksize,
+                                          format=ns.format)
+            dbconn.commit()
         except Exception as e:
-            self.dbconn.rollback()
+            dbconn.rollback()
             raise e
-        finally:
-            if _reactivate:
-                green_mode.activate()
-                self.shell.write("  green mode reactivated")
+        if self.cache is not None:
+            self.cache.clear()
+
+    @cell_magic
+    @_recorded
+    def pg_export(self, line, cell=None):
+        """Write the results of a query to a file, batch by batch.
+
+        Usage:
+            %%pg_export <file> [--format parquet|arrow|csv] [--batch N]
+                        [--row-group R] [--compression C] [--conn NAME]
+                        [--profile]
+            <query>
+
+        Arguments:
+            <file> - path of the file to write (replaced if it exists).
+            --format - 'parquet', 'arrow' (Feather v2) or 'csv'; by default
+                       guessed from the extension of <file>, else parquet.
+            [N] - rows fetched, converted and written at once (default: the
+                  'itersize' passed to the constructor); at most one batch
+                  is held in memory.
+            [R] - maximum rows per Parquet row group or Arrow record batch
+                  (default: one per batch).
+            [C] - compression codec: snappy (default), gzip, brotli, zstd
+                  or lz4 for parquet; lz4 or zstd for arrow; gzip for csv;
+                  'none' to write uncompressed.
+            [NAME] - named connection to use (see '%pg_connect').
+            --profile - print the time spent in each phase (see
+                        '%pg_stats').
+
+        CSV files (with a header) are written by 'COPY ... TO STDOUT' as the
+        server sends the data. Parquet and Arrow files (which require
+        pyarrow) are written from a server-side cursor, as for '%pg_pd
+        --chunksize'; geometries are written as hex-encoded EWKB.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('file', type=str)
+        parser.add_argument('--format', choices=("parquet", "arrow", "csv"))
+        parser.add_argument('--batch', type=int)
+        parser.add_argument('--row-group', type=int, dest='row_group')
+        parser.add_argument('--compression', type=str)
+        _add_conn_argument(parser)
+        _add_profile_argument(parser)
+        try:
+            ns = parser.parse_args(line.strip().split())
+        except SystemExit:
+            return
+
+        _profile(ns)
+        fmt = ns.format or export.guess_format(ns.file)
+        compression = (None if ns.compression is None
+                       else ns.compression.lower())
+        if compression not in export.COMPRESSION[fmt] + (None,):
+            self.shell.write_err("ERROR: {} files cannot be compressed with "
+                                 "'{}'\n".format(fmt, compression))
+            return
+
+        dbconn = self._dbconn(ns.conn)
+        sql, args = self._render(cell, dbconn)
+        frames = None
+        if fmt != "csv":
+            from . import dataframes
+            try:
+                cur = self.query(sql, conn=ns.conn, args=args, stream=True,
+                                 itersize=ns.batch, silent=True,
+                                 propagate=True, raw_geometries=True)
+            except psycopg2.Error:
+                return  # reported by 'query'
+            frames = dataframes.iter_dataframes(cur, nullable=True)
+        try:
+            if frames is None:
+                with dbconn.cursor() as cur:
+                    nrows = export.copy_to_csv(cur, sql, ns.file, args=args,
+                                               compression=compression)
+            else:
+                # errors at run time only surface while fetching; the
+                # description of 'cur' is set by the first fetch
+                first = next(frames)
+                nrows = export.write_frames(itertools.chain([first], frames),
+                                            ns.file, fmt,
+                                            compression=compression,
+                                            row_group_size=ns.row_group,
+                                            description=cur.description)
+        except ImportError:
+            self.shell.write_err("ERROR: exporting to {} requires 'pyarrow'"
+                                 "\n".format(fmt))
+            dbconn.rollback()
+            return
+        except (TypeError, ValueError) as e:  # e.g. of converting to Arrow
+            self.shell.write_err("ERROR: cannot export to {}: {}\n"
+                                 .format(fmt, str(e)))
+            dbconn.rollback()
+            return
+        except psycopg2.Error as e:
+            self.shell.write_err("ERROR: {}\n".format(str(e)))
+            stats.fail()
+            dbconn.rollback()
+            return
+
+        self.shell.write("SUCCESS: exported {} rows to '{}'\n"
+                         .format(nrows, ns.file))
+
+    @line_magic
+    def pg_cache(self, line):
+        """Control the client-side cache of query results.
+
+        Usage:
+            %pg_cache [on|off|clear|info] [--size MB] [--ttl SECONDS]
+                      [--dir PATH]
+
+        Arguments:
+            on - enable the cache (replacing any previous one); results of
+                 queries run by '%pg_sql' and '%pg_pd' are cached, keyed
+                 on the rendered query and the connection.
+            off - disable the cache.
+            clear - drop all cached results (from memory and disk).
+            info - show the cache's size and hit count (default).
+            [MB] - memory budget; least recently used results are evicted
+                   first (default: 256).
+            [SECONDS] - time after which cached results expire (default:
+                        never).
+            [PATH] - directory where DataFrames are also stored as Parquet
+                     files, read again once evicted from memory (requires
+                     pyarrow; default: none).
+
+        Statements that do not return rows (DDL, INSERT, UPDATE, ...) and
+        '%pg_copy' clear the cache automatically. Changes made by other
+        clients are not detected: use 'clear', or a TTL.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('action', type=str, nargs='?', default='info',
+                            choices=['on', 'off', 'clear', 'info'])
+        parser.add_argument('--size', type=float, default=256)
+        parser.add_argument('--ttl', type=float)
+        parser.add_argument('--dir', type=str)
+        try:
+            ns = parser.parse_args(line.strip().split())
+        except SystemExit:
+            return
+
+        if ns.action == 'on':
+            self.cache = ResultCache(maxbytes=int(ns.size * (1 << 20)),
+                                     ttl=ns.ttl, directory=ns.dir)
+        elif ns.action == 'off':
+            self.cache = None
+        elif self.cache is None:
+            self.shell.write("result cache disabled (type '%pg_cache on')\n")
+            return
+        elif ns.action == 'clear':
+            self.cache.clear()
+
+        if self.cache is not None:
+            self.shell.write("result cache: {} results, {:.1f} of {:.1f} MB, "
+                             "{} hits, {} misses\n"
+                             .format(len(self.cache),
+                                     self.cache.nbytes / (1 << 20),
+                                     self.cache.maxbytes / (1 << 20),
+                                     self.cache.hits, self.cache.misses))
+
+    @line_magic
+    def pg_stats(self, line):
+        """Return the timings of recent magics as DataFrame.
+
+        Usage:
+            %pg_stats [clear] [--last N]
+
+        Each row describes one run of '%pg_sql', '%pg_pd', '%pg_tuple',
+        '%pg_copy' or a background query: when it started, its SQL (or
+        arguments), whether it failed, the number of rows and bytes
+        transferred (where known), the total time and the time spent in
+        each phase, in seconds. 'clear' empties the history.
+
+        Phases:
+            execute - server execution and, unless streaming, the transfer
+                      of the results.
+            fetch - fetching rows, including psycopg2's typecasting (and
+                    geometry parsing).
+            build - conversion of the rows into DataFrame columns.
+            decorate - setting the index and building GeoDataFrames.
+            geometry - decoding geometries (part of 'decorate').
+            copy, parse, encode - COPY commands, parsing their output, and
+                                  serialising DataFrames for them.
+            merge - moving staged rows into the target ('%pg_copy
+                    --on-conflict').
+            write - writing files exported by '%%pg_export'.
+            render - building the HTML table of results.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('action', type=str, nargs='?',
+                            choices=['clear'])
+        parser.add_argument('--last', type=int)
+        try:
+            ns = parser.parse_args(line.strip().split())
+        except SystemExit:
+            return
+
+        if ns.action == 'clear':
+            self.history.clear()
+            return
+        dta = self.history.to_dataframe()
+        return dta if ns.last is None else dta.tail(ns.last)
 
     @cell_magic
     def pg_prepare(self, line, cell=None):
@@ -635,6 +1744,23 @@ class pgMagics(Magics):
         with as many arguments as were specified in the query (using $<x>
         notation).
 
+        The function also runs many calls at once: 'batch' takes a sequence
+        of argument tuples, or a DataFrame with one column per argument
+        (in order), e.g.:
+
+            %%pg_prepare by_day
+            select * from tbl where day = $1
+
+            dta = by_day(batch=days, as_dataframe=True)
+
+        Batches are sent 'page_size' calls per round trip (keyword argument,
+        default: 1000). Queries (starting with SELECT, WITH, VALUES or TABLE)
+        are run as one statement per page, joining the arguments with the
+        query laterally; their results are returned in the order of the
+        arguments, as one cursor or DataFrame. Other statements run through
+        EXECUTE, 'page_size' at a time, and only the results of the last
+        call are kept.
+
         Usage:
             %%pg_prepare <name> [--idx [IDX] ...]
 
@@ -670,36 +1796,330 @@ class pgMagics(Magics):
             self._preped_stmts.append(ns.name)
 
         # find number of arguments (assuming $x notation)
-        n_args = max([int(s) for s in re.findall("\$([1-9][0-9]*)", cell)])
+        n_args = max([int(m.group(2)) for m in RXP_SQL_PARAMETER.finditer(cell)
+                      if m.group(2) is not None])
 
         # compose execute statement, including placeholders
         sql = [psycopg2.sql.Placeholder()] * n_args
         sql = psycopg2.sql.SQL(", ").join(sql)
         sql = psycopg2.sql.SQL("execute {} ({})").format(name, sql)
-        sql = sql.as_string(self.dbconn)
+        # prepared statements only exist on the connection they were made on
+        dbconn = self._dbconn()
+        sql = sql.as_string(dbconn)
+        batch_sql = _lateral_batch_sql(ns.name, cell, n_args, dbconn)
 
         err_msg = "Prepared statement callback '{}' ".format(ns.name)
         err_msg += "expects {} arguments, ".format(n_args)
         err_msg += "but got {}."
 
-        def callback(*args, df=False, as_dataframe=False):
-            if len(args) != n_args:
-                raise ValueError(err_msg.format(len(args)))
+        def callback(*args, df=False, as_dataframe=False, batch=None,
+                     page_size=1000):
+            if batch is not None:
+                args = _batch_arguments(batch)
+                wrong = [len(a) for a in args if len(a) != n_args]
+            else:
+                wrong = [len(args)] if len(args) != n_args else []
+            if wrong:
+                raise ValueError(err_msg.format(wrong[0]))
+
+            if self._postgis is not None:
+                self._postgis.register_shapely2postgis_if_imported()
+            rows = None
             try:
-                cur = self.pg_cursor()
-                cur.execute(sql, args)
+                cur = dbconn.cursor()
+                if df or as_dataframe:
+                    self._raw_geometries(cur)
+                with green_mode.cancellable(dbconn):
+                    if batch is None:
+                        cur.execute(sql, args)
+                    elif batch_sql is not None:
+                        rows = psycopg2.extras.execute_values(
+                            cur, batch_sql[0],
+                            [(i,) + a for i, a in enumerate(args)],
+                            template=batch_sql[1], page_size=page_size,
+                            fetch=True)
+                    else:
+                        psycopg2.extras.execute_batch(cur, sql, args,
+                                                      page_size=page_size)
+                self._invalidate(cur)
             except psycopg2.Error as e:
-                self.dbconn.rollback()
+                dbconn.rollback()
                 raise e
 
-            if df or as_dataframe:
+            if rows is not None:
+                cur = CachedCursor(rows, cur.description)
+                if df or as_dataframe:
+                    from . import dataframes
+                    dta = dataframes.cursor_to_dataframe(cur)
+                    return self._decorate_dataframe(dta, cur.description,
+                                                    index=ns.idx,
+                                                    conn=dbconn)
+            elif df or as_dataframe:
                 return self._as_pandas_dataframe(cur, index=ns.idx)
             return cur
 
         self.shell.write(" prepared-statement at '{}'\n".format(ns.name))
         self.shell.push({ns.name: callback})
 
-def copy_pandas_dataframe(cur, dta, target, chunk=10000):
+def copy_pandas_dataframe(cur, dta, target, chunk=10000, format="csv",
+                          queue_size=4):
+    """Copy the contents of a DataFrame into an existing table using COPY.
+
+    Named indices are copied into the columns of the same name. The whole
+    DataFrame is sent in a single COPY command: a background thread
+    serialises it chunk by chunk while the previous chunks are transferred,
+    and at most 'queue_size' + 2 serialised chunks are held in memory.
+
+    Columns of shapely geometries (e.g. of GeoDataFrames) are encoded as
+    EWKB in bulk, with the SRID of the geometries or, if they have none, the
+    EPSG code of the column's CRS. This requires shapely.
+
+    Arguments:
+        cur {cursor} -- cursor to perform the COPY with.
+        dta {DataFrame} -- data to copy.
+        target {str} -- name of the target table (may be schema-qualified).
+        chunk {int} -- number of rows to serialise at once.
+        format {str} -- 'csv' to send rows as text, or 'binary' to encode
+                        them in postgres' binary COPY format, which avoids
+                        formatting numbers and timestamps as text
+                        (default: 'csv').
+        queue_size {int} -- number of serialised chunks that may wait to be
+                            sent (default: 4).
+    """
+    from . import streams
+
+    # generate copy to command
+    index, columns = _copy_columns(dta)
+    target = _table_identifier(target)
+    columns = psycopg2.sql.SQL(", ").join(psycopg2.sql.Identifier(c)
+                                          for c in columns)
+    if format == "binary":
+        chunks = _binary_chunks(cur, dta, target, columns, index, chunk)
+    elif format == "csv":
+        chunks = _csv_chunks(dta, index, chunk)
+    else:
+        raise ValueError("unknown COPY format '{}'".format(format))
+
+    sql = psycopg2.sql.SQL('COPY {} ({}) from stdin with (format {});')
+    sql = sql.format(target, columns, psycopg2.sql.SQL(format))
+
+    chunks = stats.timed(chunks, "encode")
+    with streams.ChunkReader(chunks, maxsize=queue_size) as reader, \
+            stats.phase("copy"), \
+            green_mode.cancellable(cur.connection, reader.cancel):
+        cur.copy_expert(sql, reader, size=COPY_BUFFER_SIZE)
+    stats.count(rows=len(dta))
+
+
+def parallel_copy_pandas_dataframe(pool, dta, target, jobs=2,
+                                   staging=False, on_conflict=None, key=None,
+                                   **kwargs):
+    """Copy a DataFrame over several connections at once.
+
+    The DataFrame is split into 'jobs' contiguous parts, each of which is
+    copied by 'copy_pandas_dataframe' over a connection of its own, so the
+    server parses them on as many backends.
+
+    Without 'staging', the connections commit once all parts were copied;
+    if one part fails, the others are rolled back (but the commits
+    themselves are not atomic). With 'staging', each part is copied into an
+    unlogged staging table next to 'target', and all of them are then moved
+    into 'target' by a single transaction, so that a failure at any point
+    leaves 'target' untouched. 'on_conflict' (see 'upsert_pandas_dataframe')
+    implies 'staging'.
+
+    Arguments:
+        pool {ConnectionPool} -- pool to check the connections out from.
+        dta {DataFrame} -- data to copy.
+        target {str} -- name of the target table (may be schema-qualified).
+        jobs {int} -- number of parts/connections (default: 2).
+        staging {bool} -- use staging tables (default: False).
+        on_conflict {str} -- 'update' or 'ignore' rows already in 'target'
+                             (default: None, i.e. fail on conflicts).
+        key {list} -- columns deciding about conflicts (default: the
+                      primary key of 'target').
+        kwargs -- passed on to 'copy_pandas_dataframe'.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import uuid
+
+    staging = staging or on_conflict is not None
+    bounds = np.linspace(0, len(dta), jobs + 1).astype(int)
+    parts = [dta.iloc[i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+    targets = [target] * jobs
+    if staging:
+        schema = target.split(".")[:-1]
+        token = uuid.uuid4().hex[:12]
+        targets = [".".join(schema + ["ipython_pg_stage_{}_{}"
+                                      .format(token, i)])
+                   for i in range(jobs)]
+
+    conns = []
+    try:
+        for _ in range(jobs):
+            conns.append(pool.getconn())
+        if staging:
+            for conn, stage in zip(conns, targets):
+                with conn.cursor() as cur:
+                    cur.execute(psycopg2.sql.SQL(
+                        "CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)"
+                    ).format(_table_identifier(stage),
+                             _table_identifier(target)))
+                conn.commit()
+
+        rec = stats.current()
+
+        def copy_part(conn, part, stage):
+            with stats.attach(rec), conn.cursor() as cur:
+                copy_pandas_dataframe(cur, part, stage, **kwargs)
+
+        with ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(copy_part, *args)
+                       for args in zip(conns, parts, targets)]
+        for future in futures:
+            future.result()  # re-raise the first error
+        stats.count(rows=len(dta))
+
+        for conn in conns:
+            conn.commit()
+        if not staging:
+            return
+
+        _, columns = _copy_columns(dta)
+        with conns[0].cursor() as cur:
+            if on_conflict is not None and key is None:
+                key = _primary_key(cur, target)
+            for stage in targets:
+                with green_mode.cancellable(conns[0]):
+                    cur.execute(_merge_sql(target, stage, columns,
+                                           on_conflict, key))
+        conns[0].commit()
+    finally:
+        # clean up as far as possible, without hiding the original error
+        broken = set()
+        for conn in conns:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken.add(conn)
+        for conn in (conn for conn in conns if conn not in broken):
+            if not staging:
+                break
+            try:
+                with conn.cursor() as cur:
+                    for stage in targets:
+                        cur.execute(psycopg2.sql.SQL(
+                            "DROP TABLE IF EXISTS {}"
+                        ).format(_table_identifier(stage)))
+                conn.commit()
+                break
+            except psycopg2.Error:
+                broken.add(conn)  # try the next connection
+        for conn in conns:
+            pool.putconn(conn, close=conn in broken)
+
+
+def upsert_pandas_dataframe(cur, dta, target, key=None, on_conflict="update",
+                            **kwargs):
+    """Copy a DataFrame into a table, updating or skipping existing rows.
+
+    The DataFrame is copied (see 'copy_pandas_dataframe') into a temporary
+    staging table, which is then merged into 'target' by a single
+    'INSERT ... SELECT ... ON CONFLICT' statement. Of rows with the same key
+    in 'dta', only the last one is used to update. The caller commits.
+
+    Arguments:
+        cur {cursor} -- cursor to perform the copy with.
+        dta {DataFrame} -- data to copy.
+        target {str} -- name of the target table (may be schema-qualified).
+        key {list} -- columns of the unique index or primary key deciding
+                      about conflicts (default: the primary key of
+                      'target').
+        on_conflict {str} -- 'update' to overwrite the columns of existing
+                             rows with those in 'dta', or 'ignore' to keep
+                             existing rows as they are (default: 'update').
+        kwargs -- passed on to 'copy_pandas_dataframe'.
+
+    Returns:
+        int -- number of rows inserted or updated.
+    """
+    import uuid
+
+    if on_conflict not in ("update", "ignore"):
+        raise ValueError("unknown conflict action '{}'".format(on_conflict))
+    if key is None:
+        key = _primary_key(cur, target)
+
+    _, columns = _copy_columns(dta)
+    stage = "ipython_pg_stage_{}".format(uuid.uuid4().hex[:12])
+    # temporary tables are not WAL-logged, and have no constraints to check
+    cur.execute(psycopg2.sql.SQL(
+        "CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WITH NO DATA"
+    ).format(psycopg2.sql.Identifier(stage),
+             psycopg2.sql.SQL(", ").join(psycopg2.sql.Identifier(c)
+                                         for c in columns),
+             _table_identifier(target)))
+    try:
+        copy_pandas_dataframe(cur, dta, stage, **kwargs)
+        with stats.phase("merge"), green_mode.cancellable(cur.connection):
+            cur.execute(_merge_sql(target, stage, columns, on_conflict, key))
+        merged = cur.rowcount
+    finally:
+        if (cur.connection.info.transaction_status
+                != psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+            cur.execute(psycopg2.sql.SQL("DROP TABLE IF EXISTS {}")
+                        .format(psycopg2.sql.Identifier(stage)))
+    return merged
+
+
+def _merge_sql(target, stage, columns, on_conflict=None, key=None):
+    """Compose the statement moving the rows of 'stage' into 'target'."""
+    sql = psycopg2.sql.SQL
+    ident = psycopg2.sql.Identifier
+    template = "INSERT INTO {target} ({columns}) SELECT {columns} FROM {stage}"
+    parts = dict(target=_table_identifier(target),
+                 stage=_table_identifier(stage),
+                 columns=sql(", ").join(ident(c) for c in columns))
+    if on_conflict is None:
+        return sql(template).format(**parts)
+
+    parts["key"] = sql(", ").join(ident(k) for k in key)
+    others = [c for c in columns if c not in key]
+    if on_conflict == "update" and others:
+        # a single INSERT may not update the same row twice: last one wins
+        template = ("INSERT INTO {target} ({columns}) SELECT DISTINCT ON "
+                    "({key}) {columns} FROM {stage} ORDER BY {key}, ctid DESC "
+                    "ON CONFLICT ({key}) DO UPDATE SET ({others}) = "
+                    "ROW({excluded})")
+        parts["others"] = sql(", ").join(ident(c) for c in others)
+        parts["excluded"] = sql(", ").join(sql("EXCLUDED.") + ident(c)
+                                           for c in others)
+    else:
+        template += " ON CONFLICT ({key}) DO NOTHING"
+    return sql(template).format(**parts)
+
+
+def _primary_key(cur, target):
+    """Return the names of the primary key columns of table 'target'."""
+    cur.execute("SELECT a.attname FROM pg_index i JOIN pg_attribute a "
+                "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                "WHERE i.indrelid = %s::regclass AND i.indisprimary "
+                "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+                (_table_identifier(target).as_string(cur),))
+    key = [row[0] for row in cur.fetchall()]
+    if not key:
+        raise ValueError("table '{}' has no primary key; specify the "
+                         "columns deciding about conflicts".format(target))
+    return key
+
+
+def _copy_columns(dta):
+    """Return whether to copy the index, and the names of all columns.
+
+    The index is only copied if it is named, and comes first (as in
+    'to_csv').
+    """
     # determine whether we need an index
     index = True
     columns = []
@@ -709,26 +2129,267 @@ def copy_pandas_dataframe(cur, dta, target, chunk=10000):
     else:
         columns = list(dta.index.names)
         index = True
+    return index, columns + list(dta.columns)
+
+
+def _table_identifier(name):
+    """Compose a (schema-qualified) table name that must not be quoted."""
+    name = name.replace('"', '')
+    return psycopg2.sql.SQL(".").join(psycopg2.sql.Identifier(t.strip())
+                                      for t in name.split("."))
+
+
+def _csv_chunks(dta, index, chunk):
+    """Serialise 'dta' to CSV, 'chunk' rows at a time."""
+    import pandas as pd
+
+    geometries = _geometry_srids([dta.iloc[:, i]
+                                  for i in range(dta.shape[1])])
+    for i in range(0, len(dta), chunk):
+        part = dta.iloc[i:i + chunk]
+        if geometries:
+            from . import postgis_integration
+            part = pd.DataFrame(part, copy=False)
+            for j, srid in geometries.items():
+                part.isetitem(j, postgis_integration.adapt_shapely_array(
+                    part.iloc[:, j], srid))
+        yield part.to_csv(header=False, index=index)
+
+
+def _geometry_srids(fields):
+    """Return the SRID (or None) of each field of shapely objects, by position.
+
+    The SRID is taken from the EPSG code of the field's CRS (GeoSeries).
+    """
+    srids = {}
+    for i, values in enumerate(fields):
+        if getattr(values.dtype, "name", None) != "geometry":
+            if values.dtype != object:
+                continue
+            present = values.notna().to_numpy()
+            if not (present.any() and hasattr(values.iloc[present.argmax()],
+                                              "__geo_interface__")):
+                continue
+        crs = getattr(values, "crs", None)
+        srids[i] = None if crs is None else crs.to_epsg()
+    return srids
+
+
+def _binary_chunks(cur, dta, target, columns, index, chunk):
+    """Encode 'dta' in the binary COPY format, 'chunk' rows at a time."""
+    import pandas as pd
+    from . import binary_copy, dataframes
+
+    # the binary format needs to know the exact type of each target column
+    # (queried right away, before the chunks are produced in another thread)
+    cur.execute(psycopg2.sql.SQL("SELECT {} FROM {} LIMIT 0")
+                .format(columns, target))
+    type_codes = [c.type_code for c in cur.description]
+    encoding = psycopg2.extensions.encodings[cur.connection.encoding]
+    timezone = cur.connection.get_parameter_status("TimeZone")
+
+    fields = []
+    if index:
+        fields = [pd.Series(dta.index.get_level_values(i))
+                  for i in range(dta.index.nlevels)]
+    fields += [dta.iloc[:, i] for i in range(dta.shape[1])]
+
+    # geometries are sent as EWKB, just like bytea values
+    geometries = _geometry_srids(fields)
+    for i in geometries:
+        type_codes[i] = dataframes.BYTEA
+
+    def chunks():
+        yield binary_copy.HEADER
+        for i in range(0, len(dta), chunk):
+            parts = [f.iloc[i:i + chunk] for f in fields]
+            if geometries:
+                from . import postgis_integration
+                for j, srid in geometries.items():
+                    parts[j] = postgis_integration.adapt_shapely_array(
+                        parts[j], srid, hex=False)
+            yield binary_copy.encode_rows(parts, type_codes, encoding,
+                                          timezone)
+        yield binary_copy.TRAILER
+    return chunks()
+
+@functools.lru_cache(maxsize=256)
+def _compile_template(txt):
+    """Split a query on its '${...}' expressions.
+
+    Returns:
+        tuple -- the pieces of text around the expressions (as
+                 psycopg2.sql.SQL, one more than expressions), and the
+                 (expression, format) of each expression.
+    """
+    texts = []
+    fields = []
+    start = 0
+    for match in RXP_TEMPLATE.finditer(txt):
+        texts.append(psycopg2.sql.SQL(txt[start:match.start()]))
+        fields.append((match.group(1), match.group(2)))
+        start = match.end()
+    texts.append(psycopg2.sql.SQL(txt[start:]))
+    return tuple(texts), tuple(fields)
+
+
+def _parameter_type(value):
+    """Return the type of the literal psycopg2 renders 'value' as, or None if
+    it is not known without asking the server (e.g. for lists)."""
+    kind = type(value)
+    if kind is int:
+        if -2 ** 31 < value < 2 ** 31:
+            return "integer"
+        return "bigint" if -2 ** 63 < value < 2 ** 63 else "numeric"
+    if kind is float and not math.isfinite(value):
+        return "double precision"  # rendered as e.g. 'NaN'::float
+    if kind is datetime.datetime:
+        return ("timestamp" if value.tzinfo is None
+                else "timestamp with time zone")
+    return _LITERAL_TYPES.get(kind)
+
+
+def _prepare(dbconn, sql, types):
+    """Prepare rendered 'sql' (with '%s' placeholders) on 'dbconn', with
+    parameters of the given 'types'.
+
+    Returns:
+        str -- name of the prepared statement, or None if 'sql' cannot be
+               prepared (e.g. because the types of its arguments cannot be
+               determined).
+    """
+    positions = itertools.count(1)
+    body = re.sub(r"%(%|s)", lambda m: ("%" if m.group(1) == "%"
+                                        else "${}".format(next(positions))),
+                  sql)
+    if next(positions) - 1 != len(types):
+        return None
+
+    name = "ipython_pg_auto_{}".format(next(_STATEMENT_IDS))
+    with dbconn.cursor() as cur:
+        # a failed PREPARE must not abort the transaction of the user
+        if not dbconn.autocommit:
+            cur.execute("savepoint ipython_pg_prepare")
+        try:
+            cur.execute("prepare {} ({}) as {}".format(
+                name, ", ".join(types), body))
+        except psycopg2.Error:
+            if not dbconn.autocommit:
+                cur.execute("rollback to savepoint ipython_pg_prepare")
+            return None
+        if not dbconn.autocommit:
+            cur.execute("release savepoint ipython_pg_prepare")
+    return name
+
+
+def _deallocate(dbconn, name):
+    """Deallocate the prepared statement 'name' after a failed query, if it
+    still exists, without leaving a transaction open."""
+    try:
+        with dbconn.cursor() as cur:
+            cur.execute("deallocate {}".format(name))
+    except psycopg2.Error:
+        pass  # deallocated already
+    try:
+        if not dbconn.autocommit:
+            dbconn.rollback()  # DEALLOCATE itself is not rolled back
+    except psycopg2.Error:
+        pass
+
+
+def _batch_arguments(batch):
+    """Return a batch of calls (sequence of tuples or DataFrame) as list."""
+    import pandas as pd
+
+    if isinstance(batch, pd.DataFrame):
+        batch = batch.astype(object).where(batch.notna(), None)
+        return list(batch.itertuples(index=False, name=None))
+    return [tuple(args) for args in batch]
+
+
+def _lateral_batch_sql(name, query, n_args, conn):
+    """Compose a statement running 'query' for a page of argument tuples.
+
+    The arguments are joined with the query laterally, cast to the types
+    postgres inferred for the prepared statement 'name'. For use with
+    'psycopg2.extras.execute_values', with tuples (ordinal, *arguments).
+    The rows of each call keep their order, as numbered within the call.
+
+    Returns:
+        tuple -- the statement and the template of a tuple, or None if
+                 'query' does not return rows.
+    """
+    if not re.match(r"\s*(select|with|values|table)\b", query, re.I):
+        return None
+    # parameters, but not '$n' in literals, quoted identifiers or comments
+    body = RXP_SQL_PARAMETER.sub(
+        lambda m: m.group(0) if m.group(2) is None
+        else "_args.a" + m.group(2), query.strip().rstrip(";"))
+
+    idle = (conn.info.transaction_status
+            == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+    with conn.cursor() as cur:
+        cur.execute("select parameter_types::text[] "
+                    "from pg_prepared_statements where name = %s", (name,))
+        types = cur.fetchone()[0]
+    if idle and not conn.autocommit:
+        conn.rollback()  # do not leave a transaction open
+
+    names = ", ".join("a{}".format(i + 1) for i in range(n_args))
+    sql = ("select (_result._q).* from (values %s) as _args(_ord, {}) "
+           "cross join lateral (select _q, row_number() over () as _row "
+           "from ({}\n) as _q) as _result order by _args._ord, _result._row"
+           .format(names, body.replace("%", "%%")))
+    template = "(%s, {})".format(", ".join("%s::{}".format(t)
+                                           for t in types))
+    return sql, template
+
+
+def _add_conn_argument(parser):
+    """Add the option selecting a named connection to 'parser'."""
+    parser.add_argument('--conn', type=str,
+                        help="name of the connection to use")
+
+
+def _conn_name(arg):
+    """Connection name given as line magic argument (None if empty)."""
+    arg = "" if arg is None else str(arg).strip()
+    return arg if arg else None
+
+
+def _add_profile_argument(parser):
+    """Add the option printing the timings of a magic to 'parser'."""
+    parser.add_argument('--profile', action='store_true',
+                        help="print the time spent in each phase")
+
+
+def _profile(ns):
+    """Enable printing the timings of the running magic if requested."""
+    rec = stats.current()
+    if rec is not None:
+        rec.profile = ns.profile
+
+
+def _add_async_argument(parser):
+    """Add the option running a query in the background to 'parser'."""
+    parser.add_argument('--async', dest='background', action='store_true',
+                        help="run the query in the background")
+
+
+def _add_stream_arguments(parser):
+    """Add the options controlling server-side cursors to 'parser'."""
+    parser.add_argument('--stream', action='store_true',
+                        help="fetch results through a server-side cursor")
+    parser.add_argument('--itersize', type=int,
+                        help="rows per batch when streaming (implies "
+                             "--stream)")
+
+
+def _stream_options(ns):
+    """Turn parsed '--stream'/'--itersize' into arguments for 'query'."""
+    stream = True if ns.stream or ns.itersize else None
+    return dict(stream=stream, itersize=ns.itersize)
 
-    # generate copy to command
-    target.replace('"', '')
-    target = psycopg2.sql.SQL(".").join(psycopg2.sql.Identifier(t.strip())
-                                        for t in target.split("."))
-    columns = list(dta.columns) + columns
-    columns = psycopg2.sql.SQL(", ").join(psycopg2.sql.Identifier(c)
-                                          for c in columns)
-    sql = psycopg2.sql.SQL('COPY {} ({}) from stdin with (format csv);')
-    sql = sql.format(target, columns)
-
-    # write chunk by chunk (to manage memory storage)
-    n = len(dta)
-    for i in range(0, n, chunk):
-        j = min(i + chunk, n)
-        buff = io.StringIO()
-        dta.iloc[i:j].to_csv(buff, header=False, index=index)
-        buff.seek(0)
-        cur.copy_expert(sql, buff)
-        buff.close()
 
 def _line_cell_prep(line, cell=None):
     """Default logic for line-cell magis."""
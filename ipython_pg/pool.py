@@ -0,0 +1,75 @@
+""" A small thread-safe pool of connections sharing one DSN.
+
+    Connections handed back to the pool are rolled back and kept open for
+    the next 'getconn', so repeated work does not pay for a new connection
+    (and TLS handshake) each time. The pool never blocks: if no idle
+    connection is left, a new one is opened, and at most 'maxsize' idle
+    connections are kept when they are returned.
+    """
+
+from contextlib import contextmanager
+import threading
+import psycopg2
+
+
+class ConnectionPool(object):
+    """Pool of connections to the database described by 'dsn'."""
+
+    def __init__(self, dsn, maxsize=4, connect=psycopg2.connect):
+        """Create a new (empty) pool.
+
+        Arguments:
+            dsn {str} -- data source name used to open new connections.
+            maxsize {int} -- maximum number of idle connections kept open
+                             (default: 4).
+            connect {callable} -- function opening a connection from 'dsn'
+                                  (default: psycopg2.connect).
+        """
+        self.dsn = dsn
+        self.maxsize = int(maxsize)
+        self.closed = False
+        self._connect = connect
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        """Check out an idle connection, or open a new one."""
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("connection pool is closed")
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+        return self._connect(self.dsn)
+
+    def putconn(self, conn, close=False):
+        """Return a connection; its open transaction is rolled back."""
+        if not (conn.closed or close):
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._lock:
+            if not (conn.closed or close or self.closed
+                    or len(self._idle) >= self.maxsize):
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Context manager checking out a connection for its duration."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close all idle connections and refuse to hand out new ones."""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
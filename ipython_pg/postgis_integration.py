@@ -6,17 +6,44 @@
     the scenes, and shapely objects can be passed as substitution arguments
     to cursor.execute.
 
+    For large results, "register_hexwkb_passthrough" makes a cursor return
+    the hex-wkb strings as they are, so that "cast_hexwkb_array" can decode a
+    whole column at once. Likewise, "adapt_shapely_array" encodes a whole
+    column of geometries for COPY.
+
+    The OIDs of the PostGIS types differ from database to database. They are
+    looked up with a single catalog query per server and database (see
+    "postgis_types"), and the casters are registered for each connection
+    separately.
+
+    numpy and shapely are only imported once the first geometry is converted,
+    so that activating the integration does not slow down connecting. Along
+    with them, "adapt_shapely" is registered (see "register_shapely2postgis").
+
     :author: Gil Georges <gil.georges@lav.mavt.ethz.ch>
     :date: November 23, 2016
     """
 
 import psycopg2.extensions
 import psycopg2
-import shapely.wkb
-from shapely.geometry.base import BaseGeometry
 import re
+import sys
 import warnings
 
+# PostGIS types looked up by 'postgis_types'
+POSTGIS_TYPES = ("geometry", "geography", "box2d", "box3d", "raster")
+
+SQL_TYPES = ("SELECT t.typname, t.oid, t.typarray "
+             "FROM pg_catalog.pg_type t "
+             "WHERE t.typname = ANY(%s) "
+             "ORDER BY pg_catalog.pg_type_is_visible(t.oid) DESC, t.oid")
+
+# OIDs of the PostGIS types, by (host, port, database)
+_TYPES = {}
+
+# whether 'adapt_shapely' is registered
+_ADAPTED = False
+
 
 class PostGISnotInstalled(Exception):
     """PostGIS not available in current connection."""
@@ -61,21 +88,160 @@ def cast_hexwkb(value, cur):
     """Convert PostGIS 'value' to the corresponding shapely type."""
     if value is None:
         return None
-    return shapely.wkb.loads(value, hex=True)
+    return _shapely().wkb.loads(value, hex=True)
+
+
+def cast_hexwkb_array(values):
+    """Convert an array of PostGIS values to shapely types at once.
+
+    Values that are not strings (None, or geometries decoded already) are
+    passed through. Uses the vectorized 'shapely.from_wkb' of shapely 2, and
+    'cast_hexwkb' value by value with older versions.
+
+    Returns:
+        numpy.ndarray -- of dtype object
+    """
+    import numpy as np
+    shapely = _shapely()
+
+    values = np.asarray(values, dtype=object)
+    encoded = np.fromiter((isinstance(v, (str, bytes)) for v in values),
+                          dtype=bool, count=len(values))
+    if not encoded.any():
+        return values
+
+    result = values.copy()
+    if hasattr(shapely, "from_wkb"):
+        # GEOS parses hex much slower than converting it to bytes first
+        wkb = np.empty(encoded.sum(), dtype=object)
+        wkb[:] = [bytes.fromhex(v) if isinstance(v, str) else v
+                  for v in values[encoded]]
+        result[encoded] = shapely.from_wkb(wkb)
+    else:
+        result[encoded] = [cast_hexwkb(v, None) for v in values[encoded]]
+    return result
+
+
+def _passthrough(value, cur):
+    return value
+
+
+def register_hexwkb_passthrough(type_codes, cur):
+    """Make 'cur' return values of 'type_codes' as hex-wkb strings.
+
+    This takes precedence over 'cast_hexwkb' registered globally, for the
+    rows fetched by 'cur' only.
+    """
+    typ = psycopg2.extensions.new_type(tuple(type_codes), "HEXWKB",
+                                       _passthrough)
+    psycopg2.extensions.register_type(typ, cur)
+
+
+def cast_box2d(value, cur):
+    """Convert a PostGIS box2d 'BOX(xmin ymin,xmax ymax)' to a polygon."""
+    if value is None:
+        return None
+    coords = re.findall(r"[-+0-9.eE]+", value[value.index("("):])
+    return _shapely().geometry.box(*(float(c) for c in coords))
 
 
 def adapt_shapely(value):
     """Convert a shapely object to PostGIS hex-wkb."""
-    wkb = shapely.wkb.dumps(value, hex=True, include_srid=True)
+    wkb = _shapely().wkb.dumps(value, hex=True, include_srid=True)
     return psycopg2.extensions.AsIs(psycopg2.extensions.adapt(wkb))
 
 
-def register_postgis2shapely(conn):
-    """Register 'cast_hexwkb' to transparently convert results from queries."""
-    for t_name in ("GEOGRAPHY", "GEOMETRY"):
-        t_code = get_type_code(t_name, conn)
-        typ = psycopg2.extensions.new_type((t_code,), t_name, cast_hexwkb)
-        psycopg2.extensions.register_type(typ)
+def adapt_shapely_array(values, srid=None, hex=True):
+    """Convert shapely objects to (hex-)EWKB at once, including their SRID.
+
+    Uses the vectorized 'shapely.to_wkb' of shapely 2, and 'shapely.wkb.dumps'
+    value by value with older versions.
+
+    Arguments:
+        values {array-like} -- shapely objects (or None).
+        srid {int} -- SRID of geometries that do not have one set (default:
+                      None, i.e. leave them without).
+        hex {bool} -- if True, return hex strings (for the text formats of
+                      COPY), otherwise bytes (default: True).
+
+    Returns:
+        numpy.ndarray -- of dtype object, with None for missing geometries.
+    """
+    import numpy as np
+    shapely = _shapely()
+
+    values = np.asarray(values, dtype=object)
+    if not hasattr(shapely, "to_wkb"):
+        return np.array([None if v is None else
+                         shapely.wkb.dumps(v, hex=hex, include_srid=True,
+                                           srid=srid or None)
+                         for v in values], dtype=object)
+    if srid:
+        values = values.copy()
+        missing = shapely.get_srid(values) == 0
+        values[missing] = shapely.set_srid(values[missing], int(srid))
+    return shapely.to_wkb(values, hex=hex, include_srid=True)
+
+
+def postgis_types(conn, refresh=False):
+    """Return the OIDs of the PostGIS types available through 'conn'.
+
+    The catalog is queried once per server and database; later calls, e.g.
+    for further connections of a pool, are answered from a cache. Connecting
+    anew should pass 'refresh', so that a database without PostGIS is not
+    taken to stay without it.
+
+    Arguments:
+        conn {connection} -- connection to the database.
+        refresh {bool} -- if True, query the catalog again, e.g. after
+                          'CREATE EXTENSION postgis' (default: False).
+
+    Returns:
+        dict -- (OID, OID of the array type) by name, for the types in
+                'POSTGIS_TYPES' that exist (empty without PostGIS).
+    """
+    info = conn.info
+    key = (info.host, info.port, info.dbname)
+    if refresh or key not in _TYPES:
+        idle = (info.transaction_status
+                == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        cur = conn.cursor()
+        try:
+            cur.execute(SQL_TYPES, (list(POSTGIS_TYPES),))
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+            if idle and not conn.autocommit:
+                conn.rollback()  # do not leave a transaction open
+        types = {}
+        for name, oid, array in rows:
+            types.setdefault(name, (oid, array))
+        _TYPES[key] = types
+    return _TYPES[key]
+
+
+def register_postgis2shapely(conn, refresh=False):
+    """Register 'cast_hexwkb' to transparently convert results from queries.
+
+    The casters (also for arrays of geometries, and for box2d) are only
+    registered for 'conn'. 'refresh' is passed on to 'postgis_types'.
+    """
+    types = postgis_types(conn, refresh=refresh)
+    if "geometry" not in types:
+        raise PostGISnotInstalled()
+
+    casters = {"geometry": cast_hexwkb, "geography": cast_hexwkb,
+               "box2d": cast_box2d}
+    for t_name, caster in casters.items():
+        if t_name not in types:
+            continue
+        t_code, t_array = types[t_name]
+        typ = psycopg2.extensions.new_type((t_code,), t_name.upper(), caster)
+        psycopg2.extensions.register_type(typ, conn)
+        if t_array:
+            arr = psycopg2.extensions.new_array_type(
+                (t_array,), "{}[]".format(t_name.upper()), typ)
+            psycopg2.extensions.register_type(arr, conn)
 
 
 def get_type_code(type, conn):
@@ -102,18 +268,57 @@ def get_type_object(name):
     except StopIteration:
         raise KeyError(name)
 
-def geo_types():
-    for k, v in psycopg2.extensions.string_types.items():
-        if v.name in ("GEOGRAPHY", "GEOMETRY"):
-            yield k
+def geo_types(conn=None):
+    """Return the type codes of geometries and geographies.
+
+    Arguments:
+        conn {connection} -- connection whose types to return; if None,
+                             the casters registered globally are searched
+                             (default: None).
+    """
+    if conn is None:
+        return [k for k, v in psycopg2.extensions.string_types.items()
+                if v.name in ("GEOGRAPHY", "GEOMETRY")]
+    types = postgis_types(conn)
+    return [types[t][0] for t in ("geometry", "geography") if t in types]
 
 
 def register_shapely2postgis():
     """Register 'adapt_shapely' as an adapter."""
+    global _ADAPTED
+    from shapely.geometry.base import BaseGeometry
     psycopg2.extensions.register_adapter(BaseGeometry, adapt_shapely)
+    _ADAPTED = True
 
 
-def activate(conn=None):
-    """Register postgis -> shapely and back."""
-    register_postgis2shapely(conn)
-    register_shapely2postgis()
+def register_shapely2postgis_if_imported():
+    """Register 'adapt_shapely' if shapely has been imported (by anyone).
+
+    Cheap enough to be called before every query: shapely objects can only
+    be among the query arguments once shapely has been imported.
+    """
+    if not _ADAPTED and "shapely" in sys.modules:
+        register_shapely2postgis()
+
+
+def _shapely():
+    """Import shapely (with the modules used here) on first use."""
+    import shapely.geometry
+    import shapely.wkb
+    if not _ADAPTED:
+        register_shapely2postgis()
+    return shapely
+
+
+def activate(conn=None, refresh=False):
+    """Register postgis -> shapely (for 'conn') and back.
+
+    Neither shapely nor numpy are imported here; 'adapt_shapely' is
+    registered right away only if shapely has been imported already. If
+    'refresh' is True, the PostGIS types are looked up again rather than
+    taken from the cache (see 'postgis_types').
+
+    Raises PostGISnotInstalled if PostGIS is not available through 'conn'.
+    """
+    register_postgis2shapely(conn, refresh=refresh)
+    register_shapely2postgis_if_imported()
@@ -0,0 +1,217 @@
+""" Timing of the phases of queries and transfers.
+
+    A 'Record' is opened around each magic (see 'record'); while it is open,
+    the code it runs adds the time spent in each phase (see 'phase') as well
+    as the number of rows and bytes transferred (see 'count') to it. Records
+    are tracked per thread, so nested calls (e.g. 'pgMagics.query' called by
+    '%pg_pd') add to the record of the outermost call. Without an open
+    record, 'phase' and 'count' do nothing.
+
+    Phases:
+        execute -- 'cursor.execute': server execution and, for client-side
+                   cursors, the transfer of the complete result.
+        fetch -- fetching rows, including psycopg2's typecasting (and thus
+                 parsing of geometries) and, for server-side cursors, the
+                 transfer of the rows.
+        build -- conversion of fetched rows into DataFrame columns.
+        decorate -- setting the index, building GeoDataFrames (including
+                    'geometry').
+        geometry -- decoding geometries in bulk.
+        copy -- COPY commands, including the transfer of the data.
+        parse -- parsing the output of 'COPY ... TO STDOUT'.
+        encode -- serialising DataFrames for 'COPY ... FROM STDIN'; runs in
+                  a background thread and overlaps with 'copy'.
+        merge -- moving rows from a staging table into their target, e.g.
+                 with 'INSERT ... ON CONFLICT'.
+        write -- writing exported files (see 'export').
+        render -- building the HTML table of results (of the first page; later
+                  pages are rendered, and fetched, outside of any record).
+
+    Phases of work spread over several threads (e.g. '%pg_copy --jobs') add
+    up, so they may exceed the total.
+    """
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import datetime
+import threading
+import time
+
+_local = threading.local()
+
+
+class Record(object):
+    """Timings and counts of a single magic or query."""
+
+    def __init__(self, label, sql=None):
+        self.started = datetime.datetime.now()
+        self.label = label
+        self.sql = None if sql is None else str(sql)
+        self.rows = None
+        self.bytes = None
+        self.total = None
+        self.status = "ok"
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        """Add 'seconds' to phase 'name'."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        """Return the record as flat dict (phases as '<name>_s' entries)."""
+        entry = OrderedDict([("started", self.started),
+                             ("label", self.label), ("sql", self.sql),
+                             ("status", self.status), ("rows", self.rows),
+                             ("bytes", self.bytes), ("total_s", self.total)])
+        for name, seconds in self.phases.items():
+            entry[name + "_s"] = seconds
+        return entry
+
+    def report(self):
+        """Return the breakdown of the record as text."""
+        lines = ["profile: {:.3f} s in total".format(self.total or 0.0)]
+        if self.rows is not None:
+            lines[0] += ", {} rows".format(self.rows)
+        if self.bytes is not None:
+            lines[0] += ", {:.1f} kB".format(self.bytes / 1024.)
+        for name, seconds in self.phases.items():
+            share = 100. * seconds / self.total if self.total else 0.
+            lines.append("  {:<10}{:>10.3f} s {:>5.0f}%"
+                         .format(name, seconds, share))
+        return "\n".join(lines) + "\n"
+
+
+class History(object):
+    """The most recent records, oldest first."""
+
+    def __init__(self, maxlen=1000):
+        self.records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def append(self, rec):
+        with self._lock:
+            self.records.append(rec)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+    def __len__(self):
+        return len(self.records)
+
+    def to_dataframe(self):
+        """Return the records as DataFrame, one row per record."""
+        import pandas as pd
+        with self._lock:
+            entries = [r.as_dict() for r in self.records]
+        columns = ["started", "label", "sql", "status", "rows", "bytes",
+                   "total_s"]
+        dta = pd.DataFrame(entries)
+        return dta.reindex(columns=columns + [c for c in dta.columns
+                                              if c not in columns])
+
+
+def current():
+    """Return the record open in this thread (None if there is none)."""
+    return getattr(_local, "record", None)
+
+
+@contextmanager
+def record(history, label, sql=None):
+    """Open a record, or join the one already open in this thread.
+
+    New records are appended to 'history' when closed, failed or not.
+
+    Yields:
+        Record
+    """
+    rec = current()
+    if rec is not None:
+        yield rec
+        return
+
+    rec = _local.record = Record(label, sql)
+    start = time.perf_counter()
+    try:
+        yield rec
+    except BaseException:
+        rec.status = "error"
+        raise
+    finally:
+        rec.total = time.perf_counter() - start
+        _local.record = None
+        if history is not None:
+            history.append(rec)
+
+
+@contextmanager
+def attach(rec):
+    """Make 'rec' the open record of this thread, e.g. of a worker thread."""
+    previous = current()
+    _local.record = rec
+    try:
+        yield rec
+    finally:
+        _local.record = previous
+
+
+@contextmanager
+def phase(name, rec=None):
+    """Time the enclosed block as (part of) phase 'name'.
+
+    Arguments:
+        name {str} -- name of the phase.
+        rec {Record} -- record to add to (default: the one open in this
+                        thread, if any).
+    """
+    rec = current() if rec is None else rec
+    if rec is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec.add(name, time.perf_counter() - start)
+
+
+def count(rows=None, nbytes=None, rec=None):
+    """Set the number of rows, and add to the bytes transferred."""
+    rec = current() if rec is None else rec
+    if rec is None:
+        return
+    with rec._lock:
+        if rows is not None:
+            rec.rows = int(rows)
+        if nbytes is not None:
+            rec.bytes = (rec.bytes or 0) + int(nbytes)
+
+
+def fail(rec=None):
+    """Mark the record as failed, for errors that are handled."""
+    rec = current() if rec is None else rec
+    if rec is not None:
+        rec.status = "error"
+
+
+def timed(chunks, name, rec=None):
+    """Iterate over 'chunks', timing their production as phase 'name'.
+
+    The size of each chunk is added to the bytes transferred. Meant for
+    generators that run in another thread than the one holding the record.
+    """
+    rec = current() if rec is None else rec  # before the thread starts
+    if rec is None:
+        return iter(chunks)
+
+    def generate(chunks):
+        while True:
+            with phase(name, rec):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            count(nbytes=len(chunk), rec=rec)
+            yield chunk
+    return generate(iter(chunks))
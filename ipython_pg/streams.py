@@ -0,0 +1,121 @@
+""" File-like adaptors to feed COPY commands from background threads.
+
+    'ChunkReader' runs a generator of chunks (str or bytes) in a producer
+    thread and hands them to the consumer through a bounded queue. Passed to
+    'cursor.copy_expert', it lets serialisation and network transfer overlap,
+    while never holding more than a few chunks in memory. 'cancel' makes it
+    fail, which aborts the COPY it feeds.
+    """
+
+import queue
+import threading
+
+# marks the end of the chunks in the queue
+_END = object()
+
+
+class Cancelled(Exception):
+    """Raised by 'ChunkReader.read' once the reader has been cancelled."""
+
+
+class _Failure(object):
+    """Wraps an exception raised by the producer."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class ChunkReader(object):
+    """Read-only file-like object over chunks produced in a background thread.
+
+    Usage:
+        with ChunkReader(chunks) as reader:
+            cur.copy_expert(sql, reader)
+
+    Exceptions raised while producing the chunks are re-raised by 'read'.
+    """
+
+    def __init__(self, chunks, maxsize=4):
+        """Start producing 'chunks'.
+
+        Arguments:
+            chunks {iterable} -- chunks of str or bytes to read.
+            maxsize {int} -- number of chunks that may wait in the queue;
+                             bounds the memory used (default: 4).
+        """
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._chunk = None
+        self._pos = 0
+        self._empty = b""
+        self._done = False
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(chunks,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return  # reader was closed
+            self._put(_END)
+        except BaseException as e:
+            self._put(_Failure(e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, size=-1):
+        """Return up to 'size' characters or bytes (all of a chunk if < 0)."""
+        while self._chunk is None or self._pos >= len(self._chunk):
+            if self._cancelled:
+                raise Cancelled("cancelled while reading")
+            if self._done:
+                return self._empty
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                self._done = True
+                return self._empty
+            if isinstance(item, _Failure):
+                self._done = True
+                raise item.error
+            self._chunk, self._pos = item, 0
+            self._empty = item[:0]
+
+        if size is None or size < 0:
+            size = len(self._chunk)
+        data = self._chunk[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def cancel(self):
+        """Make 'read' fail from now on; may be called from any thread."""
+        self._cancelled = True
+        self._stop.set()
+
+    def close(self):
+        """Stop the producer and release the queued chunks."""
+        self._stop.set()
+        self._done = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._chunk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()